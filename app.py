@@ -1,23 +1,38 @@
 import streamlit as st
 from datetime import datetime, date
-import pandas as pd
-import plotly.express as px
-import plotly.graph_objs as go
-import json
 import numpy as np
 from pathlib import Path
 import os
-from transformers import pipeline
 
 
-from utils import analyze_fit_file, speed_to_pace
+from chat import (
+    ANSWER_CACHE,
+    ChatBusyError,
+    answer_cache_key,
+    build_prompt,
+    get_chat_service,
+    get_readme_index,
+)
+from utils import (
+    analyze_fit_file,
+    analyze_fit_files,
+    decode_series,
+    fit_content_hash,
+    format_pace,
+    submit_background,
+    lttb_indices,
+    speed_to_pace_seconds,
+)
 from auth import (
     register_user,
     login_user,
     save_result,
-    load_test_with_data,
+    save_results,
+    load_all_test_summaries,
+    load_test_series,
     delete_test,
     update_test_date,
+    update_test_ci,
     delete_account               
 )
 
@@ -32,6 +47,10 @@ st.set_page_config(
     initial_sidebar_state="collapsed"
 )
 
+# Grafico di dettaglio: punti massimi inviati al browser e soglia per passare a WebGL
+DETAIL_MAX_POINTS = 2000
+DETAIL_WEBGL_THRESHOLD = 1000
+
 # ===============================
 #   LAYOUT INIZIALE MIGLIORATO
 # ===============================
@@ -179,68 +198,216 @@ if st.session_state.show_guide:
             st.warning("Guida non trovata (README.md mancante).")
 
 
+# ===============================
+#   ANALISI PROGRESSIVA
+# ===============================
+def _complete_ci(data, username, result_id, mode):
+    """Fase 2: bootstrap completo in background e aggiornamento della riga già salvata (per id)"""
+    result = analyze_fit_file(data, mode=mode)
+    if "error" not in result:
+        update_test_ci(username, result_id, result["ci_low"], result["ci_high"], result.get("warning"))
+    return result
+
+
+@st.fragment(run_every=2)
+def _poll_pending_ci():
+    """Controlla i calcoli dell'intervallo di confidenza in corso; al termine ricarica la pagina"""
+    pending = st.session_state.pending_ci  # id del test -> (data del test, future)
+    finished = [result_id for result_id, (_, future) in pending.items() if future.done()]
+    for result_id in finished:
+        ts, future = pending.pop(result_id)
+        try:
+            result = future.result()
+        except Exception as e:
+            result = {"error": str(e)}
+        if "error" in result:
+            st.session_state.ci_notices.append(("error", f"❌ Test del {ts}: intervallo di confidenza non calcolato ({result['error']})"))
+        elif result["ci_low"] and result["ci_high"]:
+            st.session_state.ci_notices.append(
+                ("info", f"🔹 Test del {ts}: intervallo di confidenza [{result['ci_low']:.2f}, {result['ci_high']:.2f}] m/s")
+            )
+            if result.get("warning"):
+                st.session_state.ci_notices.append(("warning", f"⚠️ Test del {ts}: {result['warning']}"))
+    if finished:
+        st.rerun()
+    st.info(f"⏳ Calcolo dell'intervallo di confidenza in corso ({len(pending)} test)...")
+
+
+# ===============================
+#   PROFILAZIONE (SOLO ADMIN)
+# ===============================
+def _is_admin(username):
+    """Gli amministratori sono elencati in ADMINS nei secrets di Streamlit"""
+    try:
+        return username in st.secrets.get("ADMINS", [])
+    except Exception:  # nessun file secrets configurato
+        return False
+
+
+def _show_profile(timings):
+    """Pannello con i tempi per fase e i contatori dell'ultima analisi"""
+    import pandas as pd
+
+    with st.expander("🛠️ Profilazione ultima analisi (admin)", expanded=False):
+        total = timings["total"]
+        spans = pd.DataFrame(
+            [(name, seconds * 1000, seconds / total if total else 0.0) for name, seconds in timings["spans"].items()],
+            columns=["Fase", "Tempo (ms)", "Quota"],
+        )
+        st.caption(f"Totale: {total * 1000:.1f} ms")
+        st.dataframe(spans.style.format({"Tempo (ms)": "{:.1f}", "Quota": "{:.0%}"}), use_container_width=True)
+        if timings["counts"]:
+            st.dataframe(
+                pd.DataFrame(list(timings["counts"].items()), columns=["Contatore", "Valore"]),
+                use_container_width=True,
+            )
+
+
 # ===============================
 # UPLOAD & ANALISI FIT
 # ===============================
 if st.session_state.logged_in:
+    is_admin = _is_admin(st.session_state.username)
+    if "pending_ci" not in st.session_state:
+        st.session_state.pending_ci = {}
+        st.session_state.ci_notices = []
+
+    # Librerie per tabelle e grafici: caricate solo dopo il login
+    import pandas as pd
+    import plotly.express as px
+    import plotly.graph_objs as go
 
     st.header("📁 Carica e Analizza un Nuovo Test Conconi")
-    uploaded_file = st.file_uploader("Carica file FIT", type=["fit"], key="uploader")
-    test_date = st.date_input("📅 Data del test", date.today())
+    batch_mode = st.checkbox("📦 Caricamento multiplo (più file FIT)", key="batch_mode")
+    analysis_mode = st.radio(
+        "Metodo di analisi",
+        ["samples", "stages"],
+        format_func=lambda m: "Campioni (1 Hz)" if m == "samples" else "Stage da 200 m (protocollo)",
+        horizontal=True,
+        key="analysis_mode",
+    )
+
+    if batch_mode:
+        uploaded_files = st.file_uploader("Carica file FIT", type=["fit"], accept_multiple_files=True, key="batch_uploader")
+        test_date = st.date_input("📅 Data dei test (usata se il file FIT non la contiene)", date.today())
+
+        batch_signature = analysis_mode + ":" + "-".join(fit_content_hash(f) for f in uploaded_files) if uploaded_files else None
+
+        if uploaded_files and st.session_state.get("last_processed_batch") != batch_signature:
+            progress = st.progress(0.0, text=f"Analisi di {len(uploaded_files)} file...")
+            to_save = []
+            # Le analisi girano in parallelo su un process pool e arrivano in ordine di completamento
+            for n_done, (i, result) in enumerate(analyze_fit_files(uploaded_files, mode=analysis_mode), start=1):
+                name = uploaded_files[i].name
+                progress.progress(n_done / len(uploaded_files), text=f"Analizzati {n_done}/{len(uploaded_files)} file")
+                if "error" in result:
+                    st.error(f"❌ {name}: {result['error']}")
+                    continue
+
+                file_date = datetime.fromtimestamp(result["start_time"]).date() if result.get("start_time") else test_date
+                st.write(
+                    f"✅ {name} ({file_date:%d-%m-%Y}): **{result['heart_rate']:.1f} bpm** – "
+                    f"**{result['speed_threshold']:.2f} m/s** – **{result['pace']}**"
+                )
+                if result.get("warning"):
+                    st.warning(f"⚠️ {name}: {result['warning']}")
+                to_save.append(dict(
+                    hr=result["heart_rate"],
+                    speed=result["speed_threshold"],
+                    pace=result["pace"],
+                    hr_list=result["heartRate"],
+                    sp_list=result["speed"],
+                    custom_date=file_date,
+                    ci_low=result["ci_low"],
+                    ci_high=result["ci_high"],
+                    warning=result.get("warning")
+                ))
+
+            # Un unico insert per tutti i test riusciti
+            n_saved = save_results(st.session_state.username, to_save)
+            st.session_state["last_processed_batch"] = batch_signature
+            st.info(f"✅ {n_saved} test salvati su {len(uploaded_files)} file caricati.")
 
-    if uploaded_file is not None:
-        file_signature = f"{uploaded_file.name}-{getattr(uploaded_file, 'size', 0)}"
     else:
-        file_signature = None
-
-    if uploaded_file and st.session_state.get("last_processed_signature") != file_signature:
-        result = analyze_fit_file(uploaded_file)
+        uploaded_file = st.file_uploader("Carica file FIT", type=["fit"], key="uploader")
+        test_date = st.date_input("📅 Data del test", date.today())
+        progressive = st.checkbox("⚡ Soglia subito, intervallo di confidenza in background", value=True, key="progressive")
 
-        if "error" in result:
-            st.error(result["error"])
+        if uploaded_file is not None:
+            file_signature = f"{analysis_mode}:{fit_content_hash(uploaded_file)}"
         else:
-            hr = result["heart_rate"]
-            sp_val = result["speed_threshold"]
-            pace = result["pace"]
-            ci_low = result["ci_low"]
-            ci_high = result["ci_high"]
-            warning = result.get("warning")
-
-            st.success(f"🎯 Soglia: **{hr:.1f} bpm** – **{sp_val:.2f} m/s** – **{pace}**")
-            if ci_low and ci_high:
-                st.info(f"🔹 Intervallo di confidenza: [{ci_low:.2f}, {ci_high:.2f}] m/s")
-            if warning:
-                st.warning(f"⚠️ Attenzione: {warning}")
-
-            # Salva come nuovo record
-            save_result(
-                st.session_state.username,
-                hr,
-                sp_val,
-                pace,
-                result["heartRate"],
-                result["speed"],
-                custom_date=test_date,
-                ci_low=ci_low,
-                ci_high=ci_high
-            )
-            st.session_state["last_processed_signature"] = file_signature
-            st.info("✅ Test salvato con successo!")
+            file_signature = None
+
+        if uploaded_file and st.session_state.get("last_processed_signature") != file_signature:
+            # In modalità progressiva la prima fase è solo la stima puntuale (niente bootstrap)
+            result = analyze_fit_file(uploaded_file, mode=analysis_mode, n_bootstrap=0 if progressive else 1000,
+                                      profile=is_admin)
+            if "timings" in result:
+                st.session_state.last_timings = result["timings"]
+
+            if "error" in result:
+                st.error(result["error"])
+            else:
+                hr = result["heart_rate"]
+                sp_val = result["speed_threshold"]
+                pace = result["pace"]
+                ci_low = result["ci_low"]
+                ci_high = result["ci_high"]
+                warning = result.get("warning")
+
+                st.success(f"🎯 Soglia: **{hr:.1f} bpm** – **{sp_val:.2f} m/s** – **{pace}**")
+                if ci_low and ci_high:
+                    st.info(f"🔹 Intervallo di confidenza: [{ci_low:.2f}, {ci_high:.2f}] m/s")
+                if warning:
+                    st.warning(f"⚠️ Attenzione: {warning}")
+
+                # Salva come nuovo record
+                result_id = save_result(
+                    st.session_state.username,
+                    hr,
+                    sp_val,
+                    pace,
+                    result["heartRate"],
+                    result["speed"],
+                    custom_date=test_date,
+                    ci_low=ci_low,
+                    ci_high=ci_high,
+                    warning=warning
+                )
+                st.session_state["last_processed_signature"] = file_signature
+                st.info("✅ Test salvato con successo!")
+
+                if progressive:
+                    st.session_state.pending_ci[result_id] = (test_date.strftime("%Y-%m-%d"), submit_background(
+                        _complete_ci, uploaded_file.getvalue(), st.session_state.username, result_id, analysis_mode
+                    ))
+
+    if is_admin and st.session_state.get("last_timings"):
+        _show_profile(st.session_state.last_timings)
+
+    # Fase 2 dell'analisi progressiva: esiti e polling dei calcoli in corso
+    for level, message in st.session_state.ci_notices:
+        getattr(st, level)(message)
+    st.session_state.ci_notices = []
+    if st.session_state.pending_ci:
+        _poll_pending_ci()
 
 
     # ---- Storico Test ----
     st.markdown("---")
     st.header("📊 Storico Test Conconi")
 
-    tests = load_test_with_data(st.session_state.username)
+    tests = load_all_test_summaries(st.session_state.username)
     if tests:
         tests = sorted(tests, key=lambda x: x["timestamp"])
         df = pd.DataFrame(
-            [(t["timestamp"][:10], t["heart_rate"], t["speed"], t["pace"]) for t in tests],
-            columns=["Data", "HR", "Speed", "Pace"]
+            [(t["timestamp"][:10], t["heart_rate"], t["speed"], t["pace"], t.get("pace_sec")) for t in tests],
+            columns=["Data", "HR", "Speed", "Pace", "Pace_sec"]
         )
+        # Test salvati prima della colonna numerica: passo ricavato dalla velocità
+        df["Pace_sec"] = df["Pace_sec"].astype(float).fillna(pd.Series(speed_to_pace_seconds(df["Speed"]), index=df.index))
 
-        st.dataframe(df, use_container_width=True)
+        st.dataframe(df.drop(columns="Pace_sec"), use_container_width=True)
 
         # ---- Grafici di Trend ----
         fig = px.line(df, x="Data", y="HR", title="Andamento Soglia FC (bpm)", markers=True)
@@ -253,14 +420,13 @@ if st.session_state.logged_in:
         )
         st.plotly_chart(fig, use_container_width=True)
 
-        df['Pace_sec'] = df['Pace'].apply(lambda x: int(x.split(":")[0])*60 + int(x.split(":")[1]))
         fig2 = px.line(df, x="Data", y="Pace_sec", title="Andamento Ritmo Soglia", markers=True)
 
         max_pace = df["Pace_sec"].max()
         min_pace = df["Pace_sec"].min()
         step = 10 if (max_pace - min_pace) <= 120 else 15 if (max_pace - min_pace) <= 240 else 30
         tickvals = list(range(int(min_pace), int(max_pace) + 1, step))
-        ticktext = [f"{v//60:02d}:{v%60:02d}" for v in tickvals]
+        ticktext = format_pace(tickvals)
 
         fig2.update_layout(
             xaxis=dict(
@@ -287,21 +453,16 @@ if st.session_state.logged_in:
             hr_val_saved = selected_test["heart_rate"]
             sp_val_saved = selected_test["speed"]
             pace_val_saved = selected_test["pace"]
-            hr_json = selected_test.get("hr_array", "[]")
-            sp_json = selected_test.get("sp_array", "[]")
+            # Le serie vengono caricate solo per il test selezionato
+            series = load_test_series(st.session_state.username, selected_test["id"])
+            hr_json = series.get("hr_array", "[]")
+            sp_json = series.get("sp_array", "[]")
             ci_low = selected_test.get("ci_low")
             ci_high = selected_test.get("ci_high")
 
-            # Funzione per convertire json/lista
+            # Funzione per convertire serie compatta / json legacy / lista
             def _to_list(x):
-                if isinstance(x, list):
-                    return x
-                if isinstance(x, str):
-                    try:
-                        return json.loads(x)
-                    except Exception:
-                        return []
-                return []
+                return decode_series(x).tolist()
 
             hr_list = _to_list(hr_json)
             sp_list = _to_list(sp_json)
@@ -310,60 +471,61 @@ if st.session_state.logged_in:
             col1, col2 = st.columns([1, 1])
             with col1:
                 if st.button("🗑️ Elimina test", use_container_width=True):
-                    delete_test(st.session_state.username, timestamp)
+                    delete_test(st.session_state.username, selected_test["id"])
                     st.success("Test eliminato.")
                     st.rerun()
             with col2:
                 new_date = st.date_input("✏️ Modifica data", pd.to_datetime(timestamp[:10]).date(), key="edit_date")
                 if st.button("💾 Salva nuova data", use_container_width=True):
                     new_timestamp = new_date.strftime("%Y-%m-%d")
-                    update_test_date(st.session_state.username, timestamp, new_timestamp)
+                    update_test_date(st.session_state.username, selected_test["id"], new_timestamp)
                     st.success("Data modificata.")
                     st.rerun()
 
             # Grafico dettagliato HR vs Pace
             if hr_list and sp_list and len(hr_list) == len(sp_list):
-                def pace_to_sec(p):
-                    m, s = p.split(":")
-                    return int(m) * 60 + int(s)
-                
-                pace_sec = [pace_to_sec(speed_to_pace(s)) for s in sp_list]
-                sorted_pairs = sorted(zip(pace_sec, hr_list), key=lambda x: x[0], reverse=True)
-                pace_sec_sorted, hr_sorted = map(list, zip(*sorted_pairs))
+                sp_arr = np.asarray(sp_list, dtype=float)
+                hr_arr = np.asarray(hr_list, dtype=float)
+                # Passo in s/km per campione, ordinato dal più lento al più veloce
+                pace_sec = speed_to_pace_seconds(sp_arr)
+                keep = np.isfinite(pace_sec)
+                order = np.argsort(-pace_sec[keep], kind="stable")
+                pace_sec_sorted = pace_sec[keep][order]
+                hr_sorted = hr_arr[keep][order]
 
                 # Calcola HR al punto soglia
                 try:
-                    sp_arr = np.array(sp_list, dtype=float)
-                    hr_arr = np.array(hr_list, dtype=float)
                     idx_near = int(np.argmin(np.abs(sp_arr - float(sp_val_saved))))
                     hr_cross = float(hr_arr[idx_near])
-                    threshold_sec = pace_to_sec(speed_to_pace(float(sp_val_saved)))
                 except Exception:
                     hr_cross = float(hr_val_saved)
-                    threshold_sec = pace_to_sec(speed_to_pace(float(sp_val_saved)))
+                threshold_sec = float(speed_to_pace_seconds(float(sp_val_saved)))
 
+                # Curva sottocampionata (LTTB) e in WebGL per i test lunghi: payload e
+                # render limitati; soglia, linee e CI restano calcolati sui dati completi
+                shown = lttb_indices(pace_sec_sorted, hr_sorted, DETAIL_MAX_POINTS)
+                scatter = go.Scattergl if shown.size > DETAIL_WEBGL_THRESHOLD else go.Scatter
                 figd = go.Figure()
-                figd.add_trace(go.Scatter(x=pace_sec_sorted, y=hr_sorted, mode="lines+markers", name="HR vs Pace", line=dict(width=2)))
-                figd.add_shape(type="line", x0=min(pace_sec_sorted), x1=max(pace_sec_sorted), y0=hr_cross, y1=hr_cross, line=dict(color="red", width=2, dash="dash"))
-                figd.add_shape(type="line", x0=threshold_sec, x1=threshold_sec, y0=min(hr_sorted), y1=max(hr_sorted), line=dict(color="green", width=2, dash="dash"))
+                figd.add_trace(scatter(x=pace_sec_sorted[shown], y=hr_sorted[shown], mode="lines+markers", name="HR vs Pace", line=dict(width=2)))
+                figd.add_shape(type="line", x0=float(pace_sec_sorted.min()), x1=float(pace_sec_sorted.max()), y0=hr_cross, y1=hr_cross, line=dict(color="red", width=2, dash="dash"))
+                figd.add_shape(type="line", x0=threshold_sec, x1=threshold_sec, y0=float(hr_sorted.min()), y1=float(hr_sorted.max()), line=dict(color="green", width=2, dash="dash"))
                 figd.add_trace(go.Scatter(x=[threshold_sec], y=[hr_cross], mode="markers", name="Soglia", marker=dict(size=10, symbol="x")))
 
                 # Rettangolo CI
                 if ci_low and ci_high:
                     try:
-                        ci_low_sec = pace_to_sec(speed_to_pace(float(ci_low)))
-                        ci_high_sec = pace_to_sec(speed_to_pace(float(ci_high)))
+                        ci_low_sec, ci_high_sec = speed_to_pace_seconds([float(ci_low), float(ci_high)])
                         x0_ci, x1_ci = min(ci_low_sec, ci_high_sec), max(ci_low_sec, ci_high_sec)
                         figd.add_vrect(x0=x0_ci, x1=x1_ci, fillcolor="red", opacity=0.1, line_width=0, annotation_text="CI 95%", annotation_position="top left")
                     except Exception:
                         pass
 
                 # Tick X
-                x_min, x_max = min(pace_sec_sorted), max(pace_sec_sorted)
+                x_min, x_max = float(pace_sec_sorted.min()), float(pace_sec_sorted.max())
                 span = x_max - x_min
                 step = 30 if span > 240 else 20 if span > 150 else 10
                 tickvals = list(range(int(np.floor(x_min / step) * step), int(np.ceil(x_max / step) * step) + 1, step))
-                ticktext = [f"{v//60:02d}:{v%60:02d}" for v in tickvals]
+                ticktext = format_pace(tickvals)
 
                 figd.update_layout(
                     title=f"Dettagli Test – {timestamp[:10]} | Soglia: {hr_val_saved:.1f} bpm @ {float(sp_val_saved):.2f} m/s ({pace_val_saved})",
@@ -384,33 +546,9 @@ if st.session_state.logged_in:
         #   SIDEBAR: CHAT OPEN-SOURCE LEGGERO (POP-UP)
         # ===============================    
 
-        import os
-        from transformers import pipeline
-
-        # Carica README.md come contesto
-        readme_path = os.path.join(os.path.dirname(__file__), "README.md")
-        with open(readme_path, "r", encoding="utf-8") as f:
-            app_description = f.read()
-
-        # Inizializza il modello solo una volta
-        if "chatbot" not in st.session_state:
-            st.session_state.chatbot = pipeline(
-                "text-generation",
-                model="EleutherAI/gpt-neo-125M",          # modello molto leggero (82M)
-                device=-1,                   # usa CPU
-                max_new_tokens=120,          # risposte corte e veloci
-                temperature=0.7,             # un po’ creativo ma coerente
-                do_sample=True,
-                top_p=0.9,
-                repetition_penalty=1.1       # evita ripetizioni
-            )
-
         if "messages" not in st.session_state:
             st.session_state.messages = []
 
-        if "cached_answers" not in st.session_state:
-            st.session_state.cached_answers = {}
-
         # ===============================
         # Chat in Pop-up separato
         # ===============================
@@ -427,29 +565,43 @@ if st.session_state.logged_in:
                 with st.chat_message("user"):
                     st.markdown(prompt)
 
-                # Cache per evitare rigenerazioni
-                cache_key = f"{timestamp[:10]}_{prompt}"
-                if cache_key in st.session_state.cached_answers:
-                    answer = st.session_state.cached_answers[cache_key]
-                else:
-                    # Prompt ottimizzato: usa README come base di conoscenza
-                    full_prompt = (
-                        "You are a support assistant for a running analysis app.\n"
-                        "Base your answers only on the following documentation:\n\n"
-                        f"{app_description}\n\n"
-                        f"User question: {prompt}\n"
-                        "Answer in simple, clear terms, with 1-2 short sentences."
-                    )
-
-                    try:
-                        output = st.session_state.chatbot(full_prompt)
-                        answer = output[0]["generated_text"].replace(full_prompt, "").strip()
-                        st.session_state.cached_answers[cache_key] = answer
-                    except Exception as e:
-                        answer = f"⚠️ Model generation error: {str(e)}"
+                # Cache globale per evitare rigenerazioni (domanda normalizzata + versione README)
+                cache_key = answer_cache_key(prompt, get_readme_index())
+                answer = ANSWER_CACHE.get(cache_key)
+                with st.chat_message("assistant"):
+                    if answer is not None:
+                        st.markdown(answer)
+                    else:
+                        # Prompt con le sole sezioni del README pertinenti alla domanda
+                        full_prompt = build_prompt(prompt, get_readme_index())
+
+                        try:
+                            # Modello unico per processo: la richiesta entra in coda e
+                            # i token vengono mostrati man mano che sono generati
+                            chat_stream = get_chat_service().stream(full_prompt)
+                            answer = st.write_stream(chat_stream).strip()
+                            ANSWER_CACHE.put(cache_key, answer)
+                            metrics = chat_stream.metrics
+                            if metrics["ttft"] is not None:
+                                st.caption(
+                                    f"Primo token {metrics['ttft']:.1f} s · {metrics['tokens_per_sec']:.1f} token/s"
+                                    + (" · interrotta per limite di tempo" if metrics["truncated"] else "")
+                                )
+                        except ChatBusyError as e:
+                            answer = f"⚠️ {e}"
+                            st.markdown(answer)
+                        except Exception as e:
+                            answer = f"⚠️ Model generation error: {str(e)}"
+                            st.markdown(answer)
 
                 st.session_state.messages.append({"role": "assistant", "content": answer})
-                with st.chat_message("assistant"):
-                    st.markdown(answer)
+
+                chat_stats = get_chat_service().stats()
+                if chat_stats["latency_p50"] is not None:
+                    st.caption(
+                        f"Coda: {chat_stats['queue_depth']} richieste · latenza p50 {chat_stats['latency_p50']:.1f} s"
+                        f" · p95 {chat_stats['latency_p95']:.1f} s · batch medio {chat_stats['avg_batch_size']:.1f}"
+                        f" · cache risposte {ANSWER_CACHE.stats()['hit_rate']:.0%}"
+                    )
 
 
@@ -1,19 +1,60 @@
-from supabase import create_client
 import bcrypt
-import json
+import functools
+import math
+import os
 import re
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from secrets import token_urlsafe
 import smtplib
-import streamlit as st
 
+import storage
+from cache import LRUCache
+from utils import (
+    encode_series,
+    HR_SERIES_DTYPE,
+    HR_SERIES_SCALE,
+    SPEED_SERIES_DTYPE,
+    SPEED_SERIES_SCALE,
+    speed_to_pace_seconds,
+)
 
 
-# Configurazione Supabase
-SUPABASE_URL = st.secrets["SUPABASE_URL"]
-SUPABASE_KEY = st.secrets["SUPABASE_KEY"]
+# Accesso ai dati tramite storage.py: backend Supabase o SQLite (CONCONI_STORAGE_BACKEND),
+# operazioni indipendenti in parallelo, retry sugli errori transitori e istogrammi di latenza.
+# Le funzioni di questo modulo restano sincrone.
 
-supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
+# ===============================
+#   CACHE DELLE QUERY
+# ===============================
+# Cache read-through per utente delle query sui risultati: ogni rerun di Streamlit
+# viene servito dalla memoria finché la voce non scade o una scrittura la invalida.
+QUERY_CACHE_TTL = float(os.environ.get("CONCONI_QUERY_CACHE_TTL", "300"))
+
+_query_cache = LRUCache(max_bytes=64 * 2**20, ttl=QUERY_CACHE_TTL)
+_MISS = object()
+
+def _read_through(func):
+    """Decoratore: legge dalla cache per utente, altrimenti esegue la query e la memorizza"""
+    @functools.wraps(func)
+    def wrapper(username, *args, **kwargs):
+        key = (username, func.__name__, args, tuple(sorted(kwargs.items())))
+        rows = _query_cache.get(key, _MISS)
+        if rows is _MISS:
+            rows = func(username, *args, **kwargs)
+            _query_cache.put(key, rows)
+        return rows
+    return wrapper
+
+def _invalidate_user(username):
+    """Invalida tutte le query in cache di un utente dopo una scrittura"""
+    _query_cache.invalidate(lambda key: key[0] == username)
+
+def query_cache_stats():
+    """Metriche della cache: hit rate e round trip verso il backend"""
+    stats = _query_cache.stats()
+    stats["round_trips"] = storage.round_trips()
+    return stats
 
 # ===============================
 #   UTILS
@@ -33,6 +74,32 @@ def check_password_strength(password: str):
         return False, "La password deve contenere almeno una lettera maiuscola"
     return True, None
 
+# ===============================
+#   HASH DELLE PASSWORD
+# ===============================
+# bcrypt gira su un pool di thread limitato (bcrypt rilascia il GIL): una raffica di
+# login non occupa i thread degli script Streamlit e non satura la CPU.
+BCRYPT_ROUNDS = int(os.environ.get("CONCONI_BCRYPT_ROUNDS", "12"))
+BCRYPT_WORKERS = int(os.environ.get("CONCONI_BCRYPT_WORKERS", "2"))
+
+_password_pool = ThreadPoolExecutor(max_workers=BCRYPT_WORKERS, thread_name_prefix="bcrypt")
+
+def hash_password(password, rounds=None):
+    """Hash bcrypt della password con il costo configurato"""
+    salt = bcrypt.gensalt(rounds or BCRYPT_ROUNDS)
+    return _password_pool.submit(bcrypt.hashpw, password.encode(), salt).result().decode()
+
+def check_password(password, hashed):
+    """Verifica la password contro un hash bcrypt"""
+    return _password_pool.submit(bcrypt.checkpw, password.encode(), hashed.encode()).result()
+
+def _hash_rounds(hashed):
+    """Costo con cui è stato calcolato un hash bcrypt ($2b$<costo>$...)"""
+    try:
+        return int(hashed.split("$")[2])
+    except (IndexError, ValueError):
+        return None
+
 # ===============================
 #   AUTENTICAZIONE
 # ===============================
@@ -43,20 +110,28 @@ def register_user(username, password):
     if not valid:
         return False, error
 
-    hashed = bcrypt.hashpw(password.encode(), bcrypt.gensalt()).decode()
-    existing = supabase.table("users").select("*").eq("username", username).execute()
-    if existing.data and len(existing.data) > 0:
+    # Prima la verifica dell'username, poi l'hash: niente bcrypt per username già presi
+    existing = storage.execute(lambda db: db.get_user(username, "username"), "users.select")
+    if existing:
         return False, "username già registrata"
-    
-    supabase.table("users").insert({"username": username, "password": hashed}).execute()
+
+    hashed = hash_password(password)
+    storage.execute(lambda db: db.insert_user(username, hashed), "users.insert")
     return True, "Registrazione completata"
 
 def login_user(username, password):
     """Login con username e password"""
-    resp = supabase.table("users").select("*").eq("username", username).execute()
-    if resp.data and len(resp.data) > 0:
-        hashed = resp.data[0]["password"].encode()
-        if bcrypt.checkpw(password.encode(), hashed):
+    user = storage.execute(lambda db: db.get_user(username, "password"), "users.select")
+    if user:
+        hashed = user["password"]
+        if check_password(password, hashed):
+            # Se il costo configurato è cambiato, la password viene ri-hashata al login
+            if _hash_rounds(hashed) != BCRYPT_ROUNDS:
+                try:
+                    new_hash = hash_password(password)
+                    storage.execute(lambda db: db.update_user(username, {"password": new_hash}), "users.update")
+                except Exception as e:
+                    print("Errore rehash password:", e)
             return True
         return False
     return False
@@ -119,53 +194,124 @@ def login_user(username, password):
 def delete_account(username):
     """Elimina definitivamente un account e tutti i suoi dati"""
     try:
-        # Elimina utente
-        resp_user = supabase.table("users").delete().eq("username", username).execute()
-        print("Resp user:", resp_user)
-        if not resp_user.data:
+        # Elimina utente e risultati in parallelo
+        user_deleted, _ = storage.execute_many(
+            ("users.delete", lambda db: db.delete_user(username)),
+            ("results.delete", lambda db: db.delete_results(username)),
+        )
+        # Qui anche se non ci sono risultati va bene, non deve fallire
+        if not user_deleted:
             print("Nessun utente trovato da eliminare")
             return False
 
-        # Elimina risultati
-        resp_results = supabase.table("results").delete().eq("username", username).execute()
-        print("Resp results:", resp_results)
-        # Qui anche se non ci sono risultati va bene, non deve fallire
-
         return True
     except Exception as e:
         print("Errore delete_account:", e)
         return False
+    finally:
+        _invalidate_user(username)
 
 
 
 # ===============================
 #   GESTIONE RISULTATI
 # ===============================
-def save_result(username, hr, speed, pace, hr_list=None, sp_list=None,
-                custom_date=None, ci_low=None, ci_high=None):
-    """Salva un test Conconi per l'utente"""
+def _result_row(username, hr, speed, pace, hr_list=None, sp_list=None,
+                custom_date=None, ci_low=None, ci_high=None, warning=None):
+    """Costruisce la riga della tabella results per un test"""
     timestamp = custom_date.strftime("%Y-%m-%d") if custom_date else datetime.now().strftime("%Y-%m-%d")
-    supabase.table("results").insert({
+    # Passo numerico (s/km) accanto a quello testuale, per i grafici senza parsing di stringhe
+    pace_sec = float(speed_to_pace_seconds(speed or 0))
+    return {
         "username": username,
         "timestamp": timestamp,
         "heart_rate": hr,
         "speed": speed,
         "pace": pace,
-        "hr_array": json.dumps(hr_list or []),
-        "sp_array": json.dumps(sp_list or []),
+        "pace_sec": round(pace_sec, 2) if math.isfinite(pace_sec) else None,
+        "hr_array": encode_series(hr_list or [], HR_SERIES_DTYPE, HR_SERIES_SCALE),
+        "sp_array": encode_series(sp_list or [], SPEED_SERIES_DTYPE, SPEED_SERIES_SCALE),
         "ci_low": ci_low,
-        "ci_high": ci_high
-    }).execute()
+        "ci_high": ci_high,
+        "warning": warning
+    }
+
+def save_result(username, hr, speed, pace, hr_list=None, sp_list=None,
+                custom_date=None, ci_low=None, ci_high=None, warning=None):
+    """Salva un test Conconi per l'utente e restituisce l'id della riga"""
+    row = _result_row(username, hr, speed, pace, hr_list, sp_list, custom_date, ci_low, ci_high, warning)
+    result_id = storage.execute(lambda db: db.insert_results([row]), "results.insert")[0]
+    _invalidate_user(username)
+    return result_id
 
+def save_results(username, results):
+    """
+    Salva più test con un unico insert.
+    `results` è una lista di dict con gli stessi argomenti di save_result (tranne username).
+    """
+    rows = [_result_row(username, **r) for r in results]
+    if rows:
+        storage.execute(lambda db: db.insert_results(rows), "results.insert")
+        _invalidate_user(username)
+    return len(rows)
+
+@_read_through
 def load_test_with_data(username):
     """Recupera tutti i test dell'utente"""
-    resp = supabase.table("results").select("*").eq("username", username).order("timestamp").execute()
-    return resp.data or []
+    return storage.execute(lambda db: db.select_results(username), "results.select")
+
+# Colonne scalari per tabella e grafici di trend (senza le serie hr_array/sp_array).
+# pace_sec e warning richiedono le colonne aggiunte da migrations/001_results_pace_sec_warning.sql
+SUMMARY_COLUMNS = "id, timestamp, heart_rate, speed, pace, pace_sec, ci_low, ci_high, warning"
+SUMMARY_PAGE_SIZE = 200
+SUMMARY_PREFETCH = 4  # pagine successive richieste insieme
+
+@_read_through
+def load_test_summaries(username, page=0, page_size=SUMMARY_PAGE_SIZE):
+    """Recupera una pagina di test dell'utente, solo colonne scalari, ordinata per data"""
+    return _summary_pages(username, [page], page_size)[0]
+
+def _summary_query(username, page, page_size):
+    return lambda db: db.select_results(username, SUMMARY_COLUMNS, offset=page * page_size, limit=page_size)
+
+def _summary_pages(username, pages, page_size):
+    """Scarica più pagine di riepiloghi in parallelo"""
+    return storage.execute_many(
+        *(("results.summaries", _summary_query(username, page, page_size)) for page in pages)
+    )
+
+@_read_through
+def load_all_test_summaries(username, page_size=SUMMARY_PAGE_SIZE):
+    """
+    Recupera tutti i riepiloghi dei test: la prima pagina da sola, poi (se piena) le
+    successive a gruppi di SUMMARY_PREFETCH pagine richieste in parallelo
+    """
+    summaries = _summary_pages(username, [0], page_size)[0]
+    page = 1
+    while len(summaries) == page * page_size:
+        for rows in _summary_pages(username, range(page, page + SUMMARY_PREFETCH), page_size):
+            summaries.extend(rows)
+        page += SUMMARY_PREFETCH
+    return summaries
+
+@_read_through
+def load_test_series(username, result_id):
+    """Recupera le serie HR/velocità di un singolo test (per id: più test possono avere la stessa data)"""
+    row = storage.execute(lambda db: db.get_result(username, result_id, "hr_array, sp_array"), "results.series")
+    return row or {}
+
+def delete_test(username, result_id):
+    """Elimina un test specifico (per id: altri test possono avere la stessa data)"""
+    storage.execute(lambda db: db.delete_result(username, result_id), "results.delete")
+    _invalidate_user(username)
 
-def delete_test(username, timestamp):
-    """Elimina un test specifico"""
-    supabase.table("results").delete().eq("username", username).eq("timestamp", timestamp).execute()
+def update_test_ci(username, result_id, ci_low, ci_high, warning=None):
+    """Aggiorna intervallo di confidenza e avviso di stabilità di un test già salvato (per id)"""
+    values = {"ci_low": ci_low, "ci_high": ci_high, "warning": warning}
+    storage.execute(lambda db: db.update_result(username, result_id, values), "results.update")
+    _invalidate_user(username)
 
-def update_test_date(username, old_ts, new_ts):
-    """Aggiorna la data di un test"""
-    supabase.table("results").update({"timestamp": new_ts}).eq("username", username).eq("timestamp", old_ts).execute()
+def update_test_date(username, result_id, new_ts):
+    """Aggiorna la data di un test (per id)"""
+    storage.execute(lambda db: db.update_result(username, result_id, {"timestamp": new_ts}), "results.update")
+    _invalidate_user(username)
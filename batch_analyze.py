@@ -0,0 +1,248 @@
+"""
+Analisi in batch, senza interfaccia web, di cartelle di file FIT: ogni file passa da
+analyze_fit_files (process pool, un worker per core di default) e produce una riga
+dell'output CSV o Parquet (scelto dall'estensione) con soglia, passo, intervallo di
+confidenza, avviso e tempi di analisi.
+
+L'elaborazione è riprendibile: i file il cui hash del contenuto è già nell'output
+vengono saltati (anche i duplicati con un altro nome), quindi dopo un'interruzione basta
+rilanciare lo stesso comando. Usa un file di output per ogni configurazione di analisi.
+
+Uso:
+    python batch_analyze.py ARCHIVIO [ARCHIVIO ...] -o risultati.csv [--workers N]
+        [--mode samples|stages] [--n-bootstrap 1000] [--retry-errors]
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from datetime import datetime, timezone
+
+from utils import STAGE_LENGTH, STAGE_TAIL, analyze_fit_files, fit_content_hash
+
+COLUMNS = [
+    "path", "sha256", "status", "error", "heart_rate", "speed_threshold", "pace", "pace_sec",
+    "ci_low", "ci_high", "warning", "start_time", "n_records", "mode", "seconds", "timings",
+    "analysed_at",
+]
+PARQUET_FLUSH_EVERY = 500  # righe tra due riscritture del file Parquet
+
+
+# ===============================
+#   INPUT
+# ===============================
+def find_fit_files(paths):
+    """Percorsi dei file .fit (anche .FIT) nelle cartelle indicate, in ordine stabile"""
+    for path in paths:
+        if os.path.isfile(path):
+            yield path
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                if name.lower().endswith(".fit"):
+                    yield os.path.join(root, name)
+
+
+# ===============================
+#   OUTPUT
+# ===============================
+def _is_parquet(path):
+    return path.lower().endswith((".parquet", ".pq"))
+
+
+def _require_pyarrow():
+    """Parquet richiede pyarrow: meglio fallire subito che dopo ore di analisi"""
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        sys.exit("L'output Parquet richiede pyarrow (pip install pyarrow); in alternativa usa un file .csv")
+
+
+def read_existing(path):
+    """Righe già presenti nell'output (lista di dict), vuota se il file non esiste"""
+    if not os.path.exists(path):
+        return []
+    if _is_parquet(path):
+        import pandas as pd
+
+        return pd.read_parquet(path).to_dict("records")
+    with open(path, newline="", encoding="utf-8") as f:
+        return list(csv.DictReader(f))
+
+
+class CsvWriter:
+    """Aggiunge righe in coda al CSV, una alla volta: un'interruzione non perde lavoro"""
+
+    def __init__(self, path, existing):
+        new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+        self._file = open(path, "a", newline="", encoding="utf-8")
+        self._writer = csv.DictWriter(self._file, fieldnames=COLUMNS)
+        if new_file:
+            self._writer.writeheader()
+
+    def write(self, row):
+        self._writer.writerow(row)
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class ParquetWriter:
+    """
+    Parquet non si può estendere in coda: le righe vengono accumulate e il file
+    riscritto (in modo atomico) ogni PARQUET_FLUSH_EVERY righe e alla chiusura.
+    """
+
+    def __init__(self, path, existing):
+        self.path = path
+        self._rows = list(existing)
+        self._unsaved = 0
+
+    def write(self, row):
+        self._rows.append(row)
+        self._unsaved += 1
+        if self._unsaved >= PARQUET_FLUSH_EVERY:
+            self._flush()
+
+    def _flush(self):
+        import pandas as pd
+
+        tmp = self.path + ".tmp"
+        pd.DataFrame(self._rows, columns=COLUMNS).to_parquet(tmp, index=False)
+        os.replace(tmp, self.path)
+        self._unsaved = 0
+
+    def close(self):
+        if self._unsaved:
+            self._flush()
+
+
+def result_row(path, digest, result, mode):
+    """Riga dell'output per il risultato di analyze_fit_file"""
+    timings = result.get("timings") or {}
+    start_time = result.get("start_time")
+    return {
+        "path": path,
+        "sha256": digest,
+        "status": "error" if "error" in result else "ok",
+        "error": result.get("error"),
+        "heart_rate": result.get("heart_rate"),
+        "speed_threshold": result.get("speed_threshold"),
+        "pace": result.get("pace"),
+        "pace_sec": result.get("pace_sec"),
+        "ci_low": result.get("ci_low"),
+        "ci_high": result.get("ci_high"),
+        "warning": result.get("warning"),
+        "start_time": (datetime.fromtimestamp(start_time, timezone.utc).isoformat()
+                       if start_time is not None else None),
+        "n_records": len(result["heartRate"]) if "heartRate" in result else None,
+        "mode": mode,
+        "seconds": timings.get("total"),
+        "timings": json.dumps({"spans": timings.get("spans", {}), "counts": timings.get("counts", {})})
+                   if timings else None,
+        "analysed_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+    }
+
+
+# ===============================
+#   BATCH
+# ===============================
+def run_batch(inputs, output, workers=None, retry_errors=False, progress_every=100, **params):
+    """
+    Analizza i file FIT di `inputs` e scrive i risultati in `output`.
+    Restituisce un riepilogo: file analizzati, saltati, errori e tempi.
+    """
+    if _is_parquet(output):
+        _require_pyarrow()
+    existing = read_existing(output)
+    if retry_errors:
+        existing = [row for row in existing if row.get("status") != "error"]
+        if os.path.exists(output) and not _is_parquet(output):
+            # Il CSV viene riscritto senza le righe in errore, che saranno rianalizzate
+            # (anche quando erano tutte in errore e non resta nessuna riga)
+            with open(output, "w", newline="", encoding="utf-8") as f:
+                writer = csv.DictWriter(f, fieldnames=COLUMNS)
+                writer.writeheader()
+                writer.writerows(existing)
+    done = {row["sha256"] for row in existing}
+    writer = (ParquetWriter if _is_parquet(output) else CsvWriter)(output, existing)
+
+    queued = []  # (percorso, hash) per indice passato ad analyze_fit_files
+    stats = {"analysed": 0, "skipped": 0, "errors": 0, "unreadable": 0, "cpu_seconds": 0.0}
+
+    def sources():
+        for path in find_fit_files(inputs):
+            try:
+                digest = fit_content_hash(path)
+            except (OSError, ValueError) as e:
+                print(f"File illeggibile {path}: {e}", file=sys.stderr)
+                stats["unreadable"] += 1
+                continue
+            if digest in done:
+                stats["skipped"] += 1
+                continue
+            done.add(digest)
+            queued.append((path, digest))
+            yield path
+
+    mode = params.get("mode", "samples")
+    start = time.perf_counter()
+    try:
+        results = analyze_fit_files(sources(), max_workers=workers, use_cache=False, profile=True, **params)
+        for i, result in results:
+            path, digest = queued[i]
+            row = result_row(path, digest, result, mode)
+            writer.write(row)
+            stats["analysed"] += 1
+            stats["errors"] += row["status"] == "error"
+            stats["cpu_seconds"] += row["seconds"] or 0.0
+            if progress_every and stats["analysed"] % progress_every == 0:
+                elapsed = time.perf_counter() - start
+                print(f"{stats['analysed']} file in {elapsed:.1f} s ({stats['analysed'] / elapsed:.1f} file/s)",
+                      file=sys.stderr)
+    finally:
+        writer.close()
+
+    stats["wall_seconds"] = time.perf_counter() - start
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("inputs", nargs="+", help="cartelle (esplorate ricorsivamente) o file FIT")
+    parser.add_argument("-o", "--output", required=True, help="file .csv o .parquet")
+    parser.add_argument("--workers", type=int, default=None, help="processi di analisi (default: core disponibili)")
+    parser.add_argument("--mode", choices=["samples", "stages"], default="samples")
+    parser.add_argument("--n-bootstrap", type=int, default=1000, help="repliche per l'intervallo di confidenza")
+    parser.add_argument("--window", type=int, default=11)
+    parser.add_argument("--polyorder", type=int, default=3)
+    parser.add_argument("--trim-start", type=int, default=20)
+    parser.add_argument("--trim-end", type=int, default=10)
+    parser.add_argument("--stage-length", type=float, default=STAGE_LENGTH)
+    parser.add_argument("--stage-tail", type=float, default=STAGE_TAIL)
+    parser.add_argument("--retry-errors", action="store_true", help="rianalizza i file finiti in errore")
+    parser.add_argument("--progress-every", type=int, default=100, help="file tra due messaggi di avanzamento")
+    args = parser.parse_args()
+
+    stats = run_batch(
+        args.inputs, args.output, workers=args.workers, retry_errors=args.retry_errors,
+        progress_every=args.progress_every, mode=args.mode, n_bootstrap=args.n_bootstrap,
+        window=args.window, polyorder=args.polyorder, trim_start=args.trim_start, trim_end=args.trim_end,
+        stage_length=args.stage_length, stage_tail=args.stage_tail,
+    )
+    wall = stats["wall_seconds"]
+    print(
+        f"Analizzati {stats['analysed']} file ({stats['errors']} con errore), saltati {stats['skipped']} "
+        f"già presenti, {stats['unreadable']} illeggibili, in {wall:.1f} s"
+    )
+    if stats["analysed"] and wall > 0:
+        # Tempo di analisi sommato sui worker / tempo reale: quanti core sono stati usati in media
+        print(f"{stats['analysed'] / wall:.1f} file/s, parallelismo effettivo {stats['cpu_seconds'] / wall:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+"""
+Benchmark delle verifiche password (login) per costo bcrypt: login/s con un solo
+thread e con il pool limitato di auth.py (CONCONI_BCRYPT_WORKERS), più il tempo di
+una registrazione (hash).
+
+Uso:
+    python benchmarks/bench_bcrypt.py [--costs 8 10 12 14] [--logins 20] [--workers 2]
+"""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import bcrypt
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--costs", type=int, nargs="+", default=[8, 10, 12, 14])
+    parser.add_argument("--logins", type=int, default=20, help="login simulati per costo")
+    parser.add_argument("--workers", type=int, default=None, help="thread del pool (default: CONCONI_BCRYPT_WORKERS)")
+    args = parser.parse_args()
+
+    if args.workers:
+        os.environ["CONCONI_BCRYPT_WORKERS"] = str(args.workers)
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import auth
+
+    password = "Password123"
+    print(f"{'costo':>5} {'hash (ms)':>10} {'login (ms)':>11} {'login/s 1 thread':>17} {f'login/s pool ({auth.BCRYPT_WORKERS})':>17}")
+    for cost in args.costs:
+        start = time.perf_counter()
+        hashed = auth.hash_password(password, rounds=cost)
+        t_hash = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for _ in range(args.logins):
+            bcrypt.checkpw(password.encode(), hashed.encode())
+        t_serial = time.perf_counter() - start
+
+        # Login concorrenti da più sessioni: passano tutti dal pool di auth.py
+        with ThreadPoolExecutor(max_workers=args.logins) as sessions:
+            start = time.perf_counter()
+            assert all(sessions.map(lambda _: auth.check_password(password, hashed), range(args.logins)))
+            t_pool = time.perf_counter() - start
+
+        print(
+            f"{cost:>5} {t_hash * 1e3:>10.1f} {t_serial / args.logins * 1e3:>11.1f}"
+            f" {args.logins / t_serial:>17.1f} {args.logins / t_pool:>17.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
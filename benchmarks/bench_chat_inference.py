@@ -0,0 +1,114 @@
+"""
+Benchmark delle modalità di inferenza su CPU del Coach AI: fp32 (configurazione attuale)
+contro quantizzazione dinamica int8, con diversi numeri di thread.
+
+Ogni configurazione gira in un processo separato, così il picco di RSS è misurato per
+configurazione. Le risposte sono generate in modo deterministico (greedy) e confrontate
+con quelle fp32: corrispondenza esatta e similarità testuale media.
+
+Uso:
+    python benchmarks/bench_chat_inference.py [--model EleutherAI/gpt-neo-125M]
+        [--threads 1 2 4] [--max-new-tokens 60] [--questions 5]
+"""
+import argparse
+import difflib
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from chat import CHAT_MODEL, ChatService, ReadmeIndex, build_prompt  # noqa: E402
+
+QUESTIONS = [
+    "How do I upload a FIT file?",
+    "What is the anaerobic threshold?",
+    "How is the confidence interval computed?",
+    "Can I change the date of a test?",
+    "How do I delete my account?",
+    "What does the smoothing window do?",
+    "Why is my test marked with a warning?",
+    "How should I run the Conconi test?",
+]
+
+
+def run_config(model, quantize, threads, max_new_tokens, questions):
+    """Esegue una configurazione e restituisce le metriche (chiamata nel processo figlio)."""
+    service = ChatService(
+        model=model,
+        quantize=quantize,
+        num_threads=threads,
+        time_budget=float("inf"),
+        generation_kwargs=dict(max_new_tokens=max_new_tokens, do_sample=False, repetition_penalty=1.1),
+    )
+    index = ReadmeIndex()
+    prompts = [build_prompt(q, index) for q in QUESTIONS[:questions]]
+
+    start = time.perf_counter()
+    list(service.stream(prompts[0]))  # caricamento del modello e riscaldamento
+    load_time = time.perf_counter() - start
+
+    answers, tokens, elapsed = [], 0, 0.0
+    for prompt in prompts:
+        chat_stream = service.stream(prompt)
+        start = time.perf_counter()
+        list(chat_stream)
+        elapsed += time.perf_counter() - start
+        tokens += chat_stream.metrics["tokens"]
+        answers.append(chat_stream.text.strip())
+
+    return {
+        "load_s": load_time,
+        "tokens_per_sec": tokens / elapsed if elapsed > 0 else 0.0,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "answers": answers,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default=CHAT_MODEL)
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--max-new-tokens", type=int, default=60)
+    parser.add_argument("--questions", type=int, default=5)
+    parser.add_argument("--run-config", help=argparse.SUPPRESS)  # uso interno: "quantize,threads"
+    args = parser.parse_args()
+
+    if args.run_config:
+        quantize, threads = args.run_config.split(",")
+        result = run_config(args.model, quantize == "1", int(threads), args.max_new_tokens, args.questions)
+        print(json.dumps(result))
+        return
+
+    configs = [(False, 0)] + [(q, t) for t in args.threads for q in (False, True)]
+    results = []
+    for quantize, threads in configs:
+        cmd = [
+            sys.executable, os.path.abspath(__file__),
+            "--model", args.model,
+            "--max-new-tokens", str(args.max_new_tokens),
+            "--questions", str(args.questions),
+            "--run-config", f"{int(quantize)},{threads}",
+        ]
+        out = subprocess.run(cmd, capture_output=True, text=True, check=True).stdout
+        results.append((quantize, threads, json.loads(out.strip().splitlines()[-1])))
+
+    reference = results[0][2]["answers"]
+    print(f"{'modalità':>8} {'thread':>6} {'token/s':>8} {'RSS (MB)':>9} {'carico (s)':>10} {'uguali':>7} {'similarità':>10}")
+    for quantize, threads, r in results:
+        same = sum(a == b for a, b in zip(r["answers"], reference))
+        similarity = sum(
+            difflib.SequenceMatcher(None, a, b).ratio() for a, b in zip(r["answers"], reference)
+        ) / len(reference)
+        print(
+            f"{'int8' if quantize else 'fp32':>8} {threads or 'def':>6} {r['tokens_per_sec']:>8.1f}"
+            f" {r['peak_rss_mb']:>9.0f} {r['load_s']:>10.2f} {same:>3}/{len(reference):<3} {similarity:>10.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+"""
+Benchmark del decoder FIT: percorso a liste (fitdecode) contro fast path colonnare.
+
+Uso:
+    python benchmarks/bench_fit_decode.py file1.fit [file2.fit ...] [--repeat 5]
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import get_conconi_data  # noqa: E402
+
+
+def best_of(fn, repeat):
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("files", nargs="+", help="file FIT da decodificare")
+    parser.add_argument("--repeat", type=int, default=5, help="ripetizioni per file (si tiene la migliore)")
+    args = parser.parse_args()
+
+    print(f"{'file':<32} {'record':>8} {'liste (s)':>10} {'colonne (s)':>12} {'speedup':>8} {'uguali':>7}")
+    for path in args.files:
+        t_list, (hr_list, sp_list, err_list) = best_of(lambda: get_conconi_data(path), args.repeat)
+        t_col, (hr_col, sp_col, err_col) = best_of(lambda: get_conconi_data(path, columnar=True), args.repeat)
+        if err_list or err_col:
+            print(f"{os.path.basename(path):<32} errore: {err_list or err_col}")
+            continue
+
+        same = (
+            len(hr_list) == len(hr_col)
+            and np.array_equal(np.asarray(hr_list, dtype=float), hr_col)
+            and np.allclose(np.asarray(sp_list, dtype=float), sp_col)
+        )
+        print(
+            f"{os.path.basename(path):<32} {len(hr_col):>8} {t_list:>10.4f} {t_col:>12.4f} "
+            f"{t_list / t_col:>7.1f}x {'sì' if same else 'NO':>7}"
+        )
+
+
+if __name__ == "__main__":
+    main()
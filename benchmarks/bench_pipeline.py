@@ -0,0 +1,137 @@
+"""
+Benchmark delle fasi della pipeline di analisi su file FIT sintetici (synth_fit.py)
+di dimensione crescente: tempo (migliore di `--repeat`), throughput in record/s e picco
+di memoria (tracemalloc) per fase.
+
+Fasi: decodifica fitdecode (get_conconi_data), decodifica colonnare, rimozione outlier,
+smoothing, aggregazione per stage, fit della soglia (senza bootstrap), bootstrap.
+
+Uso:
+    python benchmarks/bench_pipeline.py [--sizes 1000 10000 100000] [--repeat 3]
+        [--baseline benchmarks/baseline_pipeline.json] [--save-baseline] [--tolerance 0.5]
+
+Con un baseline esce con codice 1 se una fase è più lenta (o usa più memoria) del
+baseline oltre la tolleranza relativa.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from synth_fit import make_conconi_fit, records_for  # noqa: E402
+from utils import (  # noqa: E402
+    aggregate_stages,
+    bootstrap_threshold,
+    calculate_anaerobic_threshold,
+    fit_two_segments,
+    get_conconi_data,
+    read_record_columns,
+    remove_outliers_pair,
+    smooth_data,
+)
+
+DEFAULT_BASELINE = os.path.join(HERE, "baseline_pipeline.json")
+DEFAULT_SIZES = [1000, 3000, 10000, 30000, 100000]
+
+
+def build_stages(data, n_bootstrap):
+    """Fasi da misurare: (nome, funzione senza argomenti). Gli input di ogni fase sono precalcolati."""
+    columns = read_record_columns(data)
+    hr, sp = columns["heart_rate"], columns["speed"]
+    hr_f, sp_f = remove_outliers_pair(hr, sp)
+    hr_s, sp_s = smooth_data(hr_f), smooth_data(sp_f)
+    _, _, hr_fit, _ = fit_two_segments(sp_s, hr_s)
+    residuals = hr_s - hr_fit
+
+    return [
+        ("decode_fitdecode", lambda: get_conconi_data(data)),
+        ("decode_columnar", lambda: read_record_columns(data)),
+        ("remove_outliers", lambda: remove_outliers_pair(hr, sp)),
+        ("smooth", lambda: (smooth_data(hr_f), smooth_data(sp_f))),
+        ("aggregate_stages", lambda: aggregate_stages(hr, sp, columns["distance"], columns["timestamp"])),
+        ("threshold_fit", lambda: calculate_anaerobic_threshold(hr, sp, n_bootstrap=0)),
+        ("bootstrap", lambda: bootstrap_threshold(sp_s, hr_fit, residuals, n_bootstrap=n_bootstrap, rng=0)),
+    ], hr.size
+
+
+def measure(func, repeat):
+    """Migliore tempo su `repeat` esecuzioni e picco di memoria di un'esecuzione tracciata."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return best, peak
+
+
+def compare(results, baseline, tolerance):
+    """Elenco delle regressioni rispetto al baseline (tempo o memoria oltre la tolleranza)."""
+    regressions = []
+    for key, current in results.items():
+        ref = baseline.get(key)
+        if ref is None:
+            continue
+        for metric in ("seconds", "peak_bytes"):
+            if ref[metric] > 0 and current[metric] > ref[metric] * (1 + tolerance):
+                regressions.append(f"{key} {metric}: {current[metric]:.4g} contro {ref[metric]:.4g} del baseline")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--n-bootstrap", type=int, default=100)
+    parser.add_argument("--skip", nargs="*", default=[], help="fasi da saltare (es. decode_fitdecode)")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="sovrascrive il baseline con i risultati")
+    parser.add_argument("--tolerance", type=float, default=0.5, help="peggioramento relativo ammesso")
+    args = parser.parse_args()
+
+    results = {}
+    print(f"{'record':>7} {'fase':<17} {'tempo (ms)':>11} {'record/s':>12} {'picco (MB)':>11}")
+    for size in args.sizes:
+        warmup = min(300, size // 10)
+        stages, step = records_for(size, warmup=warmup)
+        data = make_conconi_fit(stages=stages, speed_step=step, warmup=warmup, seed=size)
+        phases, n_records = build_stages(data, args.n_bootstrap)
+        for name, func in phases:
+            if name in args.skip:
+                continue
+            seconds, peak = measure(func, args.repeat)
+            results[f"{size}/{name}"] = {"records": int(n_records), "seconds": seconds, "peak_bytes": peak}
+            print(f"{n_records:>7} {name:<17} {seconds * 1e3:>11.2f} {n_records / seconds:>12,.0f} {peak / 2**20:>11.2f}")
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print(f"Baseline salvato in {args.baseline}")
+        return
+
+    if not os.path.exists(args.baseline):
+        print("Nessun baseline: esegui con --save-baseline per crearlo.")
+        return
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline, args.tolerance)
+    for line in regressions:
+        print(f"❌ Regressione: {line}")
+    if regressions:
+        sys.exit(1)
+    print(f"✅ Nessuna regressione oltre il {args.tolerance:.0%} rispetto al baseline")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""
+Benchmark del backend di storage SQLite (offline, senza servizi remoti): popola un
+database temporaneo con `--users` utenti da `--tests` test ciascuno, poi misura le
+operazioni di auth.py (riepiloghi, serie, salvataggio) con `--sessions` sessioni
+concorrenti. Riporta le latenze per operazione dagli istogrammi di storage.py.
+
+Uso:
+    python benchmarks/bench_storage.py [--users 50] [--tests 200] [--sessions 8] [--requests 200]
+"""
+import argparse
+import datetime
+import os
+import random
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--tests", type=int, default=200, help="test per utente")
+    parser.add_argument("--sessions", type=int, default=8, help="sessioni concorrenti")
+    parser.add_argument("--requests", type=int, default=200, help="richieste per sessione")
+    parser.add_argument("--db", default=None, help="file SQLite (default: temporaneo)")
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    os.environ["CONCONI_STORAGE_BACKEND"] = "sqlite"
+    os.environ["CONCONI_SQLITE_PATH"] = args.db or os.path.join(tmpdir, "bench.db")
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import auth
+    import storage
+
+    hr_list = [120 + i % 60 for i in range(1200)]
+    sp_list = [3.0 + (i % 60) / 20 for i in range(1200)]
+    first_day = datetime.date(2015, 1, 1)
+    start = time.perf_counter()
+    for u in range(args.users):
+        auth.save_results(f"user{u}", [
+            dict(hr=170 + t % 10, speed=4.2, pace="3:58", hr_list=hr_list, sp_list=sp_list,
+                 custom_date=first_day + datetime.timedelta(days=t), ci_low=4.0, ci_high=4.4)
+            for t in range(args.tests)
+        ])
+    print(f"Popolamento: {args.users * args.tests} test in {time.perf_counter() - start:.2f} s")
+    ids = {f"user{u}": [t["id"] for t in auth.load_all_test_summaries(f"user{u}")] for u in range(args.users)}
+
+    def session(seed):
+        rng = random.Random(seed)
+        for _ in range(args.requests):
+            username = f"user{rng.randrange(args.users)}"
+            op = rng.random()
+            if op < 0.6:
+                # Cache delle query disattivata: ogni richiesta arriva al database
+                auth.load_all_test_summaries.__wrapped__(username)
+            elif op < 0.95:
+                auth.load_test_series.__wrapped__(username, rng.choice(ids[username]))
+            else:
+                auth.update_test_ci(username, ids[username][0], 4.0, 4.4)
+
+    storage._histograms.clear()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.sessions) as pool:
+        list(pool.map(session, range(args.sessions)))
+    elapsed = time.perf_counter() - start
+    total = args.sessions * args.requests
+    print(f"{total} richieste da {args.sessions} sessioni in {elapsed:.2f} s ({total / elapsed:,.0f} richieste/s)")
+
+    # I percentili sono limiti superiori dei bucket dell'istogramma (il primo è 5 ms)
+    print(f"{'operazione':<18} {'n':>7} {'media (ms)':>11} {'p95 <= (ms)':>12}")
+    for name, stats in sorted(storage.latency_stats().items()):
+        print(f"{name:<18} {stats['count']:>7} {stats['mean'] * 1e3:>11.3f} {stats['p95'] * 1e3:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+Benchmark del fit a due segmenti: motore esatto (utils.fit_two_segments) contro pwlf.
+
+Uso:
+    python benchmarks/bench_threshold_fit.py [--sizes 100 1000 10000] [--seed 0]
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import fit_two_segments  # noqa: E402
+
+try:
+    import pwlf
+except ImportError:  # pwlf è solo il riferimento di confronto
+    pwlf = None
+
+
+def synthetic_curve(n, rng):
+    """Curva HR/velocità con deflessione a una velocità casuale."""
+    sp = np.sort(rng.uniform(3.0, 6.0, n))
+    breakpoint = rng.uniform(4.0, 5.0)
+    hr = 80 + 20 * sp - 12 * np.maximum(0.0, sp - breakpoint) + rng.normal(0, 2, n)
+    return sp, hr
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    print(f"{'n':>7} {'esatto (ms)':>12} {'pwlf (ms)':>10} {'speedup':>8} {'bp esatto':>10} {'bp pwlf':>9} {'ΔSSE pwlf':>11}")
+    for n in args.sizes:
+        sp, hr = synthetic_curve(n, rng)
+
+        t_exact = float("inf")
+        for _ in range(5):
+            start = time.perf_counter()
+            bp, _, hr_fit, _ = fit_two_segments(sp, hr)
+            t_exact = min(t_exact, time.perf_counter() - start)
+        sse_exact = np.sum((hr - hr_fit) ** 2)
+
+        if pwlf is None:
+            print(f"{n:>7} {t_exact * 1e3:>12.2f} {'-':>10} {'-':>8} {bp:>10.4f} {'-':>9} {'-':>11}")
+            continue
+
+        start = time.perf_counter()
+        model = pwlf.PiecewiseLinFit(sp, hr)
+        breaks = model.fit(2)
+        t_pwlf = time.perf_counter() - start
+        sse_pwlf = np.sum((hr - model.predict(sp)) ** 2)
+
+        print(
+            f"{n:>7} {t_exact * 1e3:>12.2f} {t_pwlf * 1e3:>10.1f} {t_pwlf / t_exact:>7.0f}x "
+            f"{bp:>10.4f} {breaks[1]:>9.4f} {sse_pwlf - sse_exact:>11.2e}"
+        )
+
+
+if __name__ == "__main__":
+    main()
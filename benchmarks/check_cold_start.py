@@ -0,0 +1,55 @@
+"""
+Controllo dell'avvio a freddo: renderizza la pagina di login di app.py con l'AppTest di
+Streamlit in un processo nuovo, misura il tempo e verifica che le dipendenze pesanti
+(chat, fit, storage, grafici) non siano state importate.
+
+Uso:
+    python benchmarks/check_cold_start.py [--max-seconds 3.0]
+
+Esce con codice 1 se il tempo supera il limite o se un modulo pesante è stato caricato.
+"""
+import argparse
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Moduli che la pagina di login non deve importare
+HEAVY_MODULES = ("torch", "transformers", "scipy", "fitdecode", "supabase", "pandas")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--max-seconds", type=float, default=3.0, help="limite per il render della pagina di login")
+    args = parser.parse_args()
+
+    sys.path.insert(0, ROOT)
+    os.chdir(ROOT)
+    from streamlit.testing.v1 import AppTest
+
+    start = time.perf_counter()
+    at = AppTest.from_file(os.path.join(ROOT, "app.py"), default_timeout=60)
+    at.run()
+    elapsed = time.perf_counter() - start
+
+    failed = False
+    if at.exception:
+        print(f"❌ Errore durante il render: {at.exception[0].message}")
+        failed = True
+
+    loaded = [name for name in HEAVY_MODULES if name in sys.modules]
+    print(f"Render pagina di login: {elapsed:.2f} s (limite {args.max_seconds:.2f} s)")
+    if elapsed > args.max_seconds:
+        print("❌ Tempo di avvio oltre il limite")
+        failed = True
+    if loaded:
+        print(f"❌ Moduli pesanti importati al login: {', '.join(loaded)}")
+        failed = True
+    if not failed:
+        print("✅ Avvio a freddo entro il limite")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
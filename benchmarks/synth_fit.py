@@ -0,0 +1,153 @@
+"""
+Generatore di file FIT sintetici di un test Conconi: riscaldamento a ritmo blando, poi
+stage da 200 m a velocità crescente. La FC segue la velocità in modo lineare fino al
+punto di deflessione, poi cresce più lentamente; risponde con un ritardo esponenziale
+e ha rumore gaussiano. Si possono simulare perdite di segnale (FC non valida) e buchi
+nella registrazione.
+
+Uso:
+    python benchmarks/synth_fit.py out.fit [--stages 20] [--deflection 4.8] [--noise 1.5]
+        [--dropout 0.01] [--gaps 0.0] [--warmup 300] [--seed 0]
+
+Da codice: make_conconi_fit(...) restituisce i byte del file, records_for(n) il numero
+di stage che produce circa `n` record.
+"""
+import argparse
+import struct
+
+import numpy as np
+
+FIT_EPOCH = 631065600  # 1989-12-31 00:00:00 UTC in secondi Unix
+
+_CRC_TABLE = [
+    0x0000, 0xCC01, 0xD801, 0x1400, 0xF001, 0x3C00, 0x2800, 0xE401,
+    0xA001, 0x6C00, 0x7800, 0xB401, 0x5000, 0x9C01, 0x8801, 0x4400,
+]
+
+# Tipi base FIT usati nelle definizioni
+_ENUM, _UINT8, _UINT16, _UINT32 = 0x00, 0x02, 0x84, 0x86
+
+
+def _crc16(data, crc=0):
+    for byte in data:
+        tmp = _CRC_TABLE[crc & 0xF]
+        crc = ((crc >> 4) & 0x0FFF) ^ tmp ^ _CRC_TABLE[byte & 0xF]
+        tmp = _CRC_TABLE[crc & 0xF]
+        crc = ((crc >> 4) & 0x0FFF) ^ tmp ^ _CRC_TABLE[(byte >> 4) & 0xF]
+    return crc
+
+
+def _definition(local, global_num, fields):
+    out = struct.pack("<BBBHB", 0x40 | local, 0, 0, global_num, len(fields))
+    for num, size, base_type in fields:
+        out += struct.pack("BBB", num, size, base_type)
+    return out
+
+
+def conconi_series(stages=20, start_speed=3.0, speed_step=0.14, stage_length=200.0,
+                   warmup=300, warmup_speed=2.5, deflection=None, hr_rest=70.0,
+                   hr_slope=22.0, slope_after=0.35, tau=15.0, noise=1.5,
+                   speed_noise=0.05, rng=None):
+    """
+    Serie a 1 Hz del test: (velocità m/s, FC bpm, distanza m). `deflection` è la velocità
+    del punto di deflessione (default: al 70% della rampa); dopo, la pendenza della FC
+    scende a `slope_after` volte quella iniziale.
+    """
+    rng = np.random.default_rng(rng)
+    stage_speeds = start_speed + speed_step * np.arange(stages)
+    if deflection is None:
+        deflection = start_speed + 0.7 * (stage_speeds[-1] - start_speed)
+
+    durations = np.ceil(stage_length / stage_speeds).astype(int)
+    target = np.concatenate([np.full(warmup, warmup_speed), np.repeat(stage_speeds, durations)])
+    speed = np.clip(target + rng.normal(0, speed_noise, target.size), 0.1, None)
+
+    hr_target = hr_rest + hr_slope * np.minimum(target, deflection)
+    hr_target += slope_after * hr_slope * np.maximum(0.0, target - deflection)
+    # Risposta della FC con ritardo del primo ordine
+    hr = np.empty_like(hr_target)
+    alpha = 1.0 - np.exp(-1.0 / tau)
+    level = hr_target[0]
+    for i, value in enumerate(hr_target):
+        level += alpha * (value - level)
+        hr[i] = level
+    hr += rng.normal(0, noise, hr.size)
+
+    distance = np.cumsum(speed)
+    return speed, hr, distance
+
+
+def make_conconi_fit(stages=20, deflection=None, noise=1.5, dropout=0.01, gaps=0.0,
+                     warmup=300, start_time=1_700_000_000, seed=0, **series_kwargs):
+    """
+    Byte di un file FIT con i messaggi file_id, record (timestamp, FC, velocità, distanza)
+    ed eventi periodici. `dropout` è la frazione di record con FC non valida (0xFF),
+    `gaps` la frazione di secondi senza record.
+    """
+    rng = np.random.default_rng(seed)
+    speed, hr, distance = conconi_series(
+        stages=stages, deflection=deflection, noise=noise, warmup=warmup, rng=rng, **series_kwargs
+    )
+    n = speed.size
+    keep = rng.random(n) >= gaps
+    invalid_hr = rng.random(n) < dropout
+    timestamp = start_time - FIT_EPOCH
+
+    body = bytearray()
+    body += _definition(0, 0, [(0, 1, _ENUM), (1, 2, _UINT16), (2, 2, _UINT16), (4, 4, _UINT32)])
+    body += struct.pack("<BBHHI", 0, 4, 1, 1, timestamp)
+    body += _definition(1, 20, [(253, 4, _UINT32), (3, 1, _UINT8), (6, 2, _UINT16), (5, 4, _UINT32)])
+    body += _definition(2, 21, [(253, 4, _UINT32), (0, 1, _ENUM), (1, 1, _ENUM)])
+
+    hr_raw = np.where(invalid_hr, 0xFF, np.clip(np.round(hr), 0, 254)).astype(int)
+    sp_raw = np.round(speed * 1000).astype(int)
+    dist_raw = np.round(distance * 100).astype(int)
+    record = struct.Struct("<BIBHI")
+    for i in np.flatnonzero(keep):
+        body += record.pack(1, timestamp + int(i), int(hr_raw[i]), int(sp_raw[i]), int(dist_raw[i]))
+        if i % 300 == 0:
+            body += struct.pack("<BIBB", 2, timestamp + int(i), 0, 3)
+
+    header = struct.pack("<BBHI4s", 14, 0x20, 2132, len(body), b".FIT")
+    header += struct.pack("<H", _crc16(header))
+    data = header + bytes(body)
+    return data + struct.pack("<H", _crc16(data))
+
+
+def records_for(n_records, warmup=300, start_speed=3.0, speed_step=0.14, stage_length=200.0):
+    """
+    Parametri (stages, speed_step) per circa `n_records` record: per i file lunghi il
+    passo tra gli stage si riduce, così la rampa resta tra le stesse velocità.
+    """
+    end_speed = start_speed + speed_step * 19
+    stages = 20
+    while True:
+        step = (end_speed - start_speed) / (stages - 1)
+        speeds = start_speed + step * np.arange(stages)
+        total = warmup + int(np.ceil(stage_length / speeds).sum())
+        if total >= n_records or stages > 100_000:
+            return stages, step
+        stages = max(stages + 1, int(stages * n_records / total))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("output")
+    parser.add_argument("--stages", type=int, default=20)
+    parser.add_argument("--deflection", type=float, default=None, help="velocità di deflessione (m/s)")
+    parser.add_argument("--noise", type=float, default=1.5, help="deviazione standard della FC (bpm)")
+    parser.add_argument("--dropout", type=float, default=0.01, help="frazione di record con FC non valida")
+    parser.add_argument("--gaps", type=float, default=0.0, help="frazione di secondi senza record")
+    parser.add_argument("--warmup", type=int, default=300, help="secondi di riscaldamento")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    data = make_conconi_fit(stages=args.stages, deflection=args.deflection, noise=args.noise,
+                            dropout=args.dropout, gaps=args.gaps, warmup=args.warmup, seed=args.seed)
+    with open(args.output, "wb") as f:
+        f.write(data)
+    print(f"Scritto {args.output}: {len(data)} byte")
+
+
+if __name__ == "__main__":
+    main()
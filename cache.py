@@ -0,0 +1,200 @@
+import hashlib
+import os
+import pickle
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+
+# ===============================
+#   CACHE LRU CON SPILL SU DISCO
+# ===============================
+_FLOAT_SIZE = sys.getsizeof(0.0)
+
+
+def memory_size(value):
+    """
+    Stima dei byte occupati in memoria da `value`, contenuto compreso: una lista di float
+    Python costa 8 byte di puntatore più 24 di oggetto per elemento, molto più del pickle.
+    Gli oggetti condivisi sono contati una volta sola.
+    """
+    seen = set()
+    stack = [value]
+    total = 0
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            # Fast path per le serie: i float non sono condivisi, si contano senza visitarli
+            floats = sum(1 for item in obj if type(item) is float)
+            total += floats * _FLOAT_SIZE
+            if floats < len(obj):
+                stack.extend(item for item in obj if type(item) is not float)
+        elif getattr(obj, "base", None) is not None and hasattr(obj, "nbytes"):
+            # Vista NumPy: getsizeof non include i dati, che appartengono all'array base
+            stack.append(obj.base)
+    return total
+
+
+class LRUCache:
+    """
+    Cache LRU thread-safe limitata in byte (dimensione in memoria stimata con memory_size).
+    Con `spill_dir` le voci espulse dalla memoria vengono scritte su disco e ricaricate
+    al successivo accesso; anche lo spazio su disco è limitato da `max_disk_bytes`.
+    Con `ttl` (secondi) le voci scadono a partire dalla loro scrittura.
+    Con `write_through` ogni voce è scritta subito anche su disco e sopravvive ai riavvii.
+    """
+
+    def __init__(self, max_bytes=256 * 2**20, spill_dir=None, max_disk_bytes=2 * 2**30, ttl=None,
+                 write_through=False):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.ttl = ttl
+        self.write_through = write_through
+        self._items = OrderedDict()  # chiave -> (valore, dimensione, scadenza)
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self.evictions = 0
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._items:
+                value, size, expires = self._items[key]
+                if expires is None or expires > time.monotonic():
+                    self._items.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._items[key]
+                self._size -= size
+
+        value = self._load_spilled(key)
+        if value is None:
+            with self._lock:
+                self.misses += 1
+            return default
+
+        with self._lock:
+            self.hits += 1
+            self.disk_hits += 1
+        self._promote(key, value)
+        return value
+
+    def put(self, key, value):
+        self._insert(key, value, write=self.write_through)
+
+    def _promote(self, key, value):
+        """Riporta in memoria una voce letta dal disco (il file esiste già)."""
+        self._insert(key, value, write=False)
+
+    def _insert(self, key, value, write):
+        size = memory_size(value)
+        evicted = []
+        with self._lock:
+            if key in self._items:
+                self._size -= self._items.pop(key)[1]
+            expires = time.monotonic() + self.ttl if self.ttl is not None else None
+            self._items[key] = (value, size, expires)
+            self._size += size
+            while self._size > self.max_bytes and self._items:
+                old_key, (old_value, old_size, _) = self._items.popitem(last=False)
+                self._size -= old_size
+                self.evictions += 1
+                evicted.append((old_key, old_value))
+        if self.write_through:
+            # Le voci espulse sono già su disco: basta scrivere quella nuova
+            if write:
+                self._spill(key, value)
+            return
+        for old_key, old_value in evicted:
+            self._spill(old_key, old_value)
+
+    def invalidate(self, match):
+        """
+        Rimuove le voci in memoria la cui chiave soddisfa `match(key)`.
+        Le voci già spostate su disco non sono enumerabili: usare solo senza `spill_dir`.
+        """
+        with self._lock:
+            keys = [key for key in self._items if match(key)]
+            for key in keys:
+                self._size -= self._items.pop(key)[1]
+        return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._size = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "items": len(self._items),
+                "bytes": self._size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "disk_hits": self.disk_hits,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+    # --- spill su disco ---
+    def _path(self, key):
+        return os.path.join(self.spill_dir, hashlib.sha256(repr(key).encode()).hexdigest() + ".pkl")
+
+    def _spill(self, key, value):
+        if not self.spill_dir:
+            return
+        payload = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        path = self._path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(payload)
+            os.replace(tmp_path, path)
+            self._trim_disk()
+        except OSError:
+            pass
+
+    def _load_spilled(self, key):
+        if not self.spill_dir:
+            return None
+        path = self._path(key)
+        try:
+            if self.ttl is not None and time.time() - os.stat(path).st_mtime > self.ttl:
+                return None
+            with open(path, "rb") as f:
+                value = pickle.load(f)
+            if self.ttl is None:
+                os.utime(path)
+            return value
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+
+    def _trim_disk(self):
+        entries = []
+        for name in os.listdir(self.spill_dir):
+            if name.endswith(".pkl"):
+                st = os.stat(os.path.join(self.spill_dir, name))
+                entries.append((st.st_mtime, st.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.spill_dir, name))
+                total -= size
+            except OSError:
+                pass
@@ -0,0 +1,508 @@
+import hashlib
+import os
+import queue
+import re
+import threading
+import time
+import unicodedata
+from collections import deque
+from concurrent.futures import Future
+
+import numpy as np
+
+from cache import LRUCache
+
+# ===============================
+#   CONFIGURAZIONE MODELLO
+# ===============================
+CHAT_MODEL = os.environ.get("CONCONI_CHAT_MODEL", "EleutherAI/gpt-neo-125M")  # modello molto leggero
+
+GENERATION_KWARGS = dict(
+    max_new_tokens=120,          # risposte corte e veloci
+    temperature=0.7,             # un po’ creativo ma coerente
+    do_sample=True,
+    top_p=0.9,
+    repetition_penalty=1.1       # evita ripetizioni
+)
+
+# Modalità di inferenza su CPU: quantizzazione dinamica int8 dei layer Linear e numero
+# di thread di torch (0 = lascia il default della libreria)
+CHAT_QUANTIZE = os.environ.get("CONCONI_CHAT_QUANTIZE", "0").lower() in ("1", "true", "yes")
+CHAT_THREADS = int(os.environ.get("CONCONI_CHAT_THREADS", "0"))
+
+# Tempo massimo (secondi) per generare una risposta: oltre, la generazione si ferma
+CHAT_TIME_BUDGET = float(os.environ.get("CONCONI_CHAT_TIME_BUDGET", "20"))
+
+
+class ChatBusyError(RuntimeError):
+    """La coda delle richieste è piena."""
+
+
+class ChatStream:
+    """
+    Risposta in streaming: iterando si ottengono i pezzi di testo man mano che il
+    modello li genera. A fine iterazione `metrics` contiene TTFT, token generati,
+    token/s e se la generazione è stata interrotta dal limite di tempo.
+    """
+
+    def __init__(self, service):
+        self._service = service
+        self._future = Future()
+        self._submitted = time.perf_counter()
+        self._done = threading.Event()
+        self.text = ""
+        self.error = None
+        self.metrics = {"ttft": None, "tokens": 0, "tokens_per_sec": 0.0, "truncated": False}
+
+    def __iter__(self):
+        # Il future si risolve con lo streamer quando la richiesta esce dalla coda
+        streamer = self._future.result()
+        for piece in streamer:
+            if not piece:
+                continue
+            if self.metrics["ttft"] is None:
+                self.metrics["ttft"] = time.perf_counter() - self._submitted
+            self.text += piece
+            yield piece
+        self._done.wait()
+        if self.error is not None:
+            raise self.error
+        self._service._record_stream(self)
+
+
+class _RowStreamer:
+    """Testo di una riga di un batch in streaming, iterabile dal ChatStream del chiamante."""
+
+    _END = object()
+
+    def __init__(self):
+        self._queue = queue.Queue()
+
+    def put(self, text):
+        self._queue.put(text)
+
+    def end(self):
+        self._queue.put(self._END)
+
+    def __iter__(self):
+        while True:
+            piece = self._queue.get()
+            if piece is self._END:
+                return
+            yield piece
+
+
+class _BatchStreamer:
+    """
+    Streamer per model.generate con più prompt: a ogni passo riceve un token per riga,
+    ne decodifica il testo in modo incrementale e lo passa al _RowStreamer della riga.
+    Una riga termina al primo token di fine sequenza; `on_finish(i, tokens, eos)` viene
+    chiamata prima di chiuderne lo stream.
+    """
+
+    def __init__(self, tokenizer, rows, eos_token_id, on_finish):
+        self.tokenizer = tokenizer
+        self.rows = rows
+        self.eos_token_id = eos_token_id
+        self.on_finish = on_finish
+        self.tokens = [[] for _ in rows]
+        self.sent = [0] * len(rows)
+        self.finished = [False] * len(rows)
+        self._prompt_seen = False
+
+    def put(self, value):
+        if not self._prompt_seen:
+            # La prima chiamata riceve i prompt
+            self._prompt_seen = True
+            return
+        for i, token in enumerate(value.reshape(len(self.rows), -1)[:, -1].tolist()):
+            if self.finished[i]:
+                continue
+            if token == self.eos_token_id:
+                self._finish(i, eos=True)
+                continue
+            self.tokens[i].append(token)
+            self._flush(i, final=False)
+
+    def end(self):
+        for i in range(len(self.rows)):
+            if not self.finished[i]:
+                self._finish(i, eos=False)
+
+    def _finish(self, i, eos):
+        self.finished[i] = True
+        self._flush(i, final=True)
+        self.on_finish(i, len(self.tokens[i]), eos)
+        self.rows[i].end()
+
+    def _flush(self, i, final):
+        text = self.tokenizer.decode(self.tokens[i], skip_special_tokens=True)
+        if not final:
+            # Solo fino all'ultima parola completa: i token successivi possono cambiarne la coda
+            text = text[:max(text.rfind(" "), text.rfind("\n")) + 1]
+        if len(text) > self.sent[i]:
+            self.rows[i].put(text[self.sent[i]:])
+            self.sent[i] = len(text)
+
+
+# ===============================
+#   SERVIZIO CHAT CONDIVISO
+# ===============================
+class ChatService:
+    """
+    Un'unica istanza del modello per processo, alimentata da una coda limitata.
+    Un thread worker raccoglie le richieste arrivate entro `batch_wait` secondi
+    (fino a `max_batch`) e le genera con una sola chiamata al modello.
+    Con `quantize` i layer Linear girano in int8 (quantizzazione dinamica su CPU);
+    `num_threads` fissa i thread di torch.
+    """
+
+    def __init__(self, model=CHAT_MODEL, max_queue=32, max_batch=8, batch_wait=0.05,
+                 time_budget=CHAT_TIME_BUDGET, quantize=CHAT_QUANTIZE, num_threads=CHAT_THREADS,
+                 generation_kwargs=None):
+        self.model = model
+        self.time_budget = time_budget
+        self.quantize = quantize
+        self.num_threads = num_threads
+        self.generation_kwargs = dict(GENERATION_KWARGS if generation_kwargs is None else generation_kwargs)
+        self.max_batch = max_batch
+        self.batch_wait = batch_wait
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._pipeline = None
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=500)
+        self._batch_sizes = deque(maxlen=500)
+        self._ttfts = deque(maxlen=500)
+        self._tokens_per_sec = deque(maxlen=500)
+        self.truncated = 0
+        self.requests = 0
+        self.rejected = 0
+        self._worker = threading.Thread(target=self._run, name="chat-worker", daemon=True)
+        self._worker.start()
+
+    def submit(self, prompt, stream=None):
+        """Accoda un prompt e restituisce un Future con la risposta (o con lo streamer)."""
+        future = stream._future if stream is not None else Future()
+        try:
+            self._queue.put_nowait((prompt, future, time.perf_counter(), stream))
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            raise ChatBusyError("Coach AI occupato, riprova tra poco.")
+        with self._lock:
+            self.requests += 1
+        return future
+
+    def generate(self, prompt, timeout=None):
+        """Genera la risposta a un prompt attendendo il proprio turno in coda."""
+        return self.submit(prompt).result(timeout)
+
+    def stream(self, prompt):
+        """
+        Accoda un prompt da generare in streaming e restituisce un ChatStream da iterare
+        per ricevere il testo man mano che viene prodotto. Le richieste in streaming
+        arrivate insieme sono generate in batch come quelle di generate().
+        """
+        chat_stream = ChatStream(self)
+        self.submit(prompt, stream=chat_stream)
+        return chat_stream
+
+    def _record_stream(self, chat_stream):
+        metrics = chat_stream.metrics
+        with self._lock:
+            if metrics["ttft"] is not None:
+                self._ttfts.append(metrics["ttft"])
+            self._tokens_per_sec.append(metrics["tokens_per_sec"])
+            self.truncated += metrics["truncated"]
+
+    def stats(self):
+        with self._lock:
+            latencies = np.array(self._latencies)
+            batch_sizes = np.array(self._batch_sizes)
+            ttfts = np.array(self._ttfts)
+            return {
+                "queue_depth": self._queue.qsize(),
+                "requests": self.requests,
+                "rejected": self.rejected,
+                "batches": len(batch_sizes),
+                "avg_batch_size": float(batch_sizes.mean()) if batch_sizes.size else 0.0,
+                "latency_p50": float(np.percentile(latencies, 50)) if latencies.size else None,
+                "latency_p95": float(np.percentile(latencies, 95)) if latencies.size else None,
+                "ttft_p50": float(np.percentile(ttfts, 50)) if ttfts.size else None,
+                "tokens_per_sec": float(np.mean(self._tokens_per_sec)) if self._tokens_per_sec else None,
+                "truncated": self.truncated,
+            }
+
+    def _load(self):
+        import torch  # torch e transformers vengono importati solo qui
+        from transformers import pipeline
+
+        if self.num_threads:
+            torch.set_num_threads(self.num_threads)
+        pipe = pipeline("text-generation", model=self.model, device=-1, **self.generation_kwargs)
+        if self.quantize:
+            # Pesi int8 e attivazioni quantizzate al volo: meno memoria e matmul più veloci su CPU
+            from torch.ao.quantization import quantize_dynamic
+            pipe.model = quantize_dynamic(pipe.model.eval(), {torch.nn.Linear}, dtype=torch.qint8)
+        # gpt-neo non ha un token di padding: serve per generare più prompt in batch
+        pipe.tokenizer.pad_token_id = pipe.model.config.eos_token_id
+        pipe.tokenizer.padding_side = "left"
+        self._inference_mode = torch.inference_mode
+        return pipe
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.perf_counter() + self.batch_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            plain = [item for item in batch if item[3] is None]
+            if plain:
+                self._process(plain)
+            streams = [item for item in batch if item[3] is not None]
+            if streams:
+                self._process_streams(streams)
+
+    def _process(self, batch):
+        prompts = [prompt for prompt, _, _, _ in batch]
+        try:
+            if self._pipeline is None:
+                self._pipeline = self._load()
+            with self._inference_mode():
+                outputs = self._pipeline(prompts, batch_size=len(prompts), return_full_text=False,
+                                         max_time=self.time_budget)
+        except Exception as e:
+            for _, future, _, _ in batch:
+                future.set_exception(e)
+            return
+
+        now = time.perf_counter()
+        with self._lock:
+            self._batch_sizes.append(len(batch))
+            for _, _, submitted, _ in batch:
+                self._latencies.append(now - submitted)
+        for (_, future, _, _), output in zip(batch, outputs):
+            future.set_result(output[0]["generated_text"].strip())
+
+    def _process_streams(self, batch):
+        """
+        Genera insieme le risposte in streaming del batch: un'unica chiamata a generate,
+        con i token di ogni riga smistati al ChatStream del rispettivo chiamante.
+        """
+        rows = [_RowStreamer() for _ in batch]
+        for (_, future, _, _), row in zip(batch, rows):
+            future.set_result(row)
+        with self._lock:
+            self._batch_sizes.append(len(batch))
+        max_new_tokens = self.generation_kwargs.get("max_new_tokens", 0)
+        start = time.perf_counter()
+
+        def on_finish(i, tokens, eos):
+            _, _, submitted, chat_stream = batch[i]
+            elapsed = time.perf_counter() - start
+            chat_stream.metrics.update(
+                tokens=tokens,
+                tokens_per_sec=tokens / elapsed if elapsed > 0 else 0.0,
+                # Interrotta dal limite di tempo prima di esaurire i token
+                truncated=bool(not eos and elapsed >= self.time_budget and tokens < max_new_tokens),
+            )
+            with self._lock:
+                self._latencies.append(time.perf_counter() - submitted)
+            chat_stream._done.set()
+
+        try:
+            if self._pipeline is None:
+                self._pipeline = self._load()
+            tokenizer, model = self._pipeline.tokenizer, self._pipeline.model
+            inputs = tokenizer([prompt for prompt, _, _, _ in batch], return_tensors="pt", padding=True)
+            streamer = _BatchStreamer(tokenizer, rows, model.config.eos_token_id, on_finish)
+            with self._inference_mode():
+                model.generate(
+                    **inputs,
+                    streamer=streamer,
+                    max_time=self.time_budget,
+                    pad_token_id=tokenizer.pad_token_id,
+                    **self.generation_kwargs,
+                )
+        except Exception as e:
+            for (_, _, _, chat_stream), row in zip(batch, rows):
+                if not chat_stream._done.is_set():
+                    chat_stream.error = e
+                    chat_stream._done.set()
+                    row.end()  # sblocca il chiamante in attesa di testo
+
+
+# ===============================
+#   RETRIEVAL SUL README (BM25)
+# ===============================
+README_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "README.md")
+
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def _tokenize(text):
+    return _TOKEN_RE.findall(text.lower())
+
+
+def split_sections(text, max_chars=800):
+    """
+    Divide il markdown in sezioni per titolo (#, ##, ...). Le sezioni lunghe vengono
+    spezzate per paragrafi, ripetendo il titolo in testa a ogni pezzo.
+    """
+    sections = []
+    title, lines = "", []
+    for line in text.splitlines():
+        if line.startswith("#"):
+            if any(l.strip() for l in lines):
+                sections.append((title, "\n".join(lines).strip()))
+            title, lines = line.strip("# ").strip(), []
+        elif line.strip() != "---":
+            lines.append(line)
+    if any(l.strip() for l in lines):
+        sections.append((title, "\n".join(lines).strip()))
+
+    chunks = []
+    for title, body in sections:
+        piece = ""
+        for paragraph in body.split("\n\n"):
+            if piece and len(piece) + len(paragraph) > max_chars:
+                chunks.append(f"{title}\n{piece.strip()}")
+                piece = ""
+            piece += paragraph + "\n\n"
+        if piece.strip():
+            chunks.append(f"{title}\n{piece.strip()}")
+    return chunks
+
+
+class ReadmeIndex:
+    """
+    Indice BM25 sulle sezioni del README. Viene ricostruito automaticamente
+    quando il file cambia (mtime o dimensione).
+    """
+
+    def __init__(self, path=README_PATH, k1=1.5, b=0.75):
+        self.path = path
+        self.k1 = k1
+        self.b = b
+        self.version = None
+        self.chunks = []
+        self._stamp = None
+        self._lock = threading.Lock()
+
+    def _refresh(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return
+        stamp = (st.st_mtime_ns, st.st_size)
+        if stamp == self._stamp:
+            return
+        with open(self.path, "r", encoding="utf-8") as f:
+            text = f.read()
+
+        chunks = split_sections(text)
+        docs = [_tokenize(chunk) for chunk in chunks]
+        vocab = {}
+        for doc in docs:
+            for token in doc:
+                vocab.setdefault(token, len(vocab))
+        tf = np.zeros((len(docs), len(vocab)))
+        for i, doc in enumerate(docs):
+            for token in doc:
+                tf[i, vocab[token]] += 1
+
+        lengths = tf.sum(axis=1)
+        df = (tf > 0).sum(axis=0)
+        self.chunks = chunks
+        self._vocab = vocab
+        self._idf = np.log(1 + (len(docs) - df + 0.5) / (df + 0.5))
+        self._tf_norm = tf * (self.k1 + 1) / (tf + self.k1 * (1 - self.b + self.b * lengths[:, None] / max(lengths.mean(), 1)))
+        self.version = hashlib.sha256(text.encode()).hexdigest()[:16]
+        self._stamp = stamp
+
+    def current_version(self):
+        """Hash del contenuto attuale del README (ricostruisce l'indice se è cambiato)."""
+        with self._lock:
+            self._refresh()
+            return self.version
+
+    def search(self, query, k=3):
+        """Restituisce i `k` pezzi più pertinenti alla domanda, nell'ordine del documento."""
+        with self._lock:
+            self._refresh()
+            if not self.chunks:
+                return []
+            ids = [self._vocab[t] for t in set(_tokenize(query)) if t in self._vocab]
+            if not ids:
+                return self.chunks[:1]
+            scores = self._tf_norm[:, ids] @ self._idf[ids]
+            top = [i for i in np.argsort(-scores)[:k] if scores[i] > 0]
+            return [self.chunks[i] for i in sorted(top)] or self.chunks[:1]
+
+
+def build_prompt(question, index, k=3):
+    """Prompt con i soli pezzi di documentazione pertinenti alla domanda."""
+    context = "\n\n".join(index.search(question, k=k))
+    return (
+        "You are a support assistant for a running analysis app.\n"
+        "Base your answers only on the following documentation:\n\n"
+        f"{context}\n\n"
+        f"User question: {question}\n"
+        "Answer in simple, clear terms, with 1-2 short sentences."
+    )
+
+
+# ===============================
+#   CACHE GLOBALE DELLE RISPOSTE
+# ===============================
+# Condivisa da tutte le sessioni; con CONCONI_CHAT_CACHE_DIR sopravvive ai riavvii
+ANSWER_CACHE = LRUCache(
+    max_bytes=8 * 2**20,
+    spill_dir=os.environ.get("CONCONI_CHAT_CACHE_DIR") or None,
+    max_disk_bytes=64 * 2**20,
+    write_through=True,
+)
+
+_PUNCTUATION_RE = re.compile(r"[^\w\s]", re.UNICODE)
+
+
+def normalize_question(text):
+    """Forma canonica della domanda: NFKC, minuscole, senza punteggiatura e spazi multipli."""
+    text = unicodedata.normalize("NFKC", text).lower()
+    return " ".join(_PUNCTUATION_RE.sub(" ", text).split())
+
+
+def answer_cache_key(question, index):
+    """Chiave della cache: domanda normalizzata + versione della documentazione."""
+    return normalize_question(question), index.current_version()
+
+
+_service = None
+_service_lock = threading.Lock()
+_readme_index = None
+
+
+def get_chat_service():
+    """Restituisce il servizio chat del processo, creandolo alla prima chiamata."""
+    global _service
+    if _service is None:
+        with _service_lock:
+            if _service is None:
+                _service = ChatService()
+    return _service
+
+
+def get_readme_index():
+    """Indice del README condiviso dal processo (costruito alla prima ricerca)."""
+    global _readme_index
+    if _readme_index is None:
+        with _service_lock:
+            if _readme_index is None:
+                _readme_index = ReadmeIndex()
+    return _readme_index
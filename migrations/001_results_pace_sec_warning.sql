@@ -0,0 +1,11 @@
+-- Colonne di results aggiunte dopo la prima versione dell'app (Supabase / Postgres).
+-- Da eseguire una volta nell'SQL editor di Supabase prima di aggiornare l'app: senza
+-- queste colonne ogni salvataggio e ogni caricamento dello storico falliscono.
+-- Il backend SQLite locale crea già lo schema completo (storage.SQLiteBackend.SCHEMA).
+
+alter table results add column if not exists pace_sec real;
+alter table results add column if not exists warning text;
+
+-- Passo numerico (secondi al km) per i test salvati prima della migrazione
+update results set pace_sec = round((1000.0 / speed)::numeric, 2)
+where pace_sec is null and speed > 0;
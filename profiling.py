@@ -0,0 +1,82 @@
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+
+# ===============================
+#   PROFILAZIONE DELLA PIPELINE
+# ===============================
+# Le funzioni instrumentate chiamano span()/count(): senza un profilo attivo costano
+# solo una lettura della ContextVar, quindi possono restare sempre nel codice.
+_current = ContextVar("conconi_profile", default=None)
+_NO_SPAN = nullcontext()
+
+logger = logging.getLogger("conconi.profile")
+# Con CONCONI_PROFILE_LOG=<file> i profili vengono scritti anche come righe JSON
+if os.environ.get("CONCONI_PROFILE_LOG"):
+    _handler = logging.FileHandler(os.environ["CONCONI_PROFILE_LOG"])
+    _handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(_handler)
+    logger.setLevel(logging.INFO)
+
+
+class Profile:
+    """Tempi per fase (secondi, sommati se una fase si ripete) e contatori di un'analisi."""
+
+    def __init__(self):
+        self.spans = {}
+        self.counts = {}
+        self._start = time.perf_counter()
+
+    @contextmanager
+    def span(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.spans[name] = self.spans.get(name, 0.0) + time.perf_counter() - start
+
+    def count(self, name, value=1):
+        self.counts[name] = self.counts.get(name, 0) + int(value)
+
+    def as_dict(self):
+        return {
+            "total": time.perf_counter() - self._start,
+            "spans": dict(self.spans),
+            "counts": dict(self.counts),
+        }
+
+
+@contextmanager
+def profiling(enabled=True):
+    """Attiva un Profile per il blocco (restituisce None se disattivato)."""
+    if not enabled:
+        yield None
+        return
+    profile = Profile()
+    token = _current.set(profile)
+    try:
+        yield profile
+    finally:
+        _current.reset(token)
+
+
+def span(name):
+    """Misura il blocco come fase `name` del profilo attivo, se presente."""
+    profile = _current.get()
+    return _NO_SPAN if profile is None else profile.span(name)
+
+
+def count(name, value=1):
+    """Incrementa il contatore `name` del profilo attivo, se presente."""
+    profile = _current.get()
+    if profile is not None:
+        profile.count(name, value)
+
+
+def log_profile(timings, **context):
+    """Scrive i tempi di un'analisi come log strutturato (una riga JSON)."""
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(json.dumps({"event": "analysis_profile", **context, **timings}, default=float))
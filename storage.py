@@ -0,0 +1,471 @@
+import asyncio
+import bisect
+import os
+import random
+import threading
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+
+import streamlit as st
+
+# ===============================
+#   ACCESSO ASINCRONO ALLO STORAGE
+# ===============================
+# Un event loop dedicato per processo, su un thread daemon, con un unico backend (client
+# async Supabase oppure database SQLite locale). Le funzioni sincrone in fondo sono la
+# facciata usata da auth.py: accodano coroutine sul loop e ne attendono il risultato, così
+# le chiamate indipendenti viaggiano in parallelo anche dagli script Streamlit sincroni.
+STORAGE_RETRIES = int(os.environ.get("CONCONI_STORAGE_RETRIES", "3"))
+STORAGE_BACKOFF = float(os.environ.get("CONCONI_STORAGE_BACKOFF", "0.1"))  # secondi, raddoppia a ogni tentativo
+
+# Codici di errore considerati transitori: HTTP 408/429/5xx, connessione Postgres (08xxx),
+# serializzazione e deadlock (40001, 40P01), server in chiusura (57P01)
+_TRANSIENT_CODES = {"408", "429", "500", "502", "503", "504", "40001", "40P01", "57P01"}
+# Sottoinsieme sicuro per le scritture non idempotenti: la richiesta è stata rifiutata
+# (429) o la transazione annullata (40001, 40P01), quindi nulla è stato scritto
+_REJECTED_CODES = {"429", "40001", "40P01"}
+
+# Backend: "supabase" (default) oppure "sqlite" per l'uso locale / offline
+STORAGE_BACKEND = os.environ.get("CONCONI_STORAGE_BACKEND", "supabase").lower()
+SQLITE_PATH = os.environ.get("CONCONI_SQLITE_PATH", "conconi.db")
+SQLITE_THREADS = int(os.environ.get("CONCONI_SQLITE_THREADS", "4"))  # query SQLite concorrenti
+
+_loop = None
+_loop_lock = threading.Lock()
+_backend = None
+
+
+def _get_loop():
+    """Event loop del processo, avviato su un thread dedicato alla prima chiamata"""
+    global _loop
+    if _loop is None:
+        with _loop_lock:
+            if _loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="storage-loop", daemon=True).start()
+                _loop = loop
+    return _loop
+
+
+def get_backend():
+    """Backend di storage del processo, scelto con CONCONI_STORAGE_BACKEND"""
+    global _backend
+    if _backend is None:
+        with _loop_lock:
+            if _backend is None:
+                if STORAGE_BACKEND == "sqlite":
+                    _backend = SQLiteBackend(SQLITE_PATH)
+                elif STORAGE_BACKEND == "supabase":
+                    _backend = SupabaseBackend()
+                else:
+                    raise ValueError(f"Backend di storage sconosciuto: {STORAGE_BACKEND}")
+    return _backend
+
+
+# ===============================
+#   INTERFACCIA DEI BACKEND
+# ===============================
+USER_COLUMNS = ("username", "password", "reset_token")
+RESULT_COLUMNS = (
+    "username", "timestamp", "heart_rate", "speed", "pace", "pace_sec",
+    "hr_array", "sp_array", "ci_low", "ci_high", "warning",
+)
+
+
+class StorageBackend(ABC):
+    """
+    Operazioni su utenti e risultati. Tutti i metodi sono coroutine eseguite sul loop di
+    storage; `columns` è una stringa "a, b, c" o "*". I risultati sono ordinati per data.
+    """
+
+    @abstractmethod
+    async def get_user(self, username, columns="*"):
+        """Riga dell'utente (dict) o None"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def insert_user(self, username, password):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def update_user(self, username, values):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def delete_user(self, username):
+        """True se l'utente esisteva ed è stato eliminato"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def insert_results(self, rows):
+        """Inserisce i test e restituisce i loro id, nello stesso ordine"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def select_results(self, username, columns="*", offset=0, limit=None):
+        """Lista di dict, ordinata per timestamp e id (ordine stabile tra le pagine)"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_result(self, username, result_id, columns="*"):
+        """Test dell'utente con quell'id (dict) o None"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def update_result(self, username, result_id, values):
+        """Aggiorna un singolo test per id"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def delete_result(self, username, result_id):
+        """Elimina un singolo test per id"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def delete_results(self, username):
+        """Elimina tutti i test dell'utente"""
+        raise NotImplementedError
+
+
+class SupabaseBackend(StorageBackend):
+    """Supabase tramite il client async: un unico pool di connessioni HTTP per processo"""
+
+    def __init__(self):
+        self._client = None
+        self._client_lock = None
+
+    async def _db(self):
+        if self._client is None:
+            if self._client_lock is None:
+                self._client_lock = asyncio.Lock()
+            async with self._client_lock:
+                if self._client is None:
+                    from supabase import acreate_client
+                    self._client = await acreate_client(st.secrets["SUPABASE_URL"], st.secrets["SUPABASE_KEY"])
+        return self._client
+
+    async def get_user(self, username, columns="*"):
+        db = await self._db()
+        resp = await db.table("users").select(columns).eq("username", username).limit(1).execute()
+        return resp.data[0] if resp.data else None
+
+    async def insert_user(self, username, password):
+        db = await self._db()
+        await db.table("users").insert({"username": username, "password": password}).execute()
+
+    async def update_user(self, username, values):
+        db = await self._db()
+        await db.table("users").update(values).eq("username", username).execute()
+
+    async def delete_user(self, username):
+        db = await self._db()
+        resp = await db.table("users").delete().eq("username", username).execute()
+        return bool(resp.data)
+
+    async def insert_results(self, rows):
+        db = await self._db()
+        resp = await db.table("results").insert(rows).execute()
+        return [row["id"] for row in resp.data]
+
+    async def select_results(self, username, columns="*", offset=0, limit=None):
+        db = await self._db()
+        query = db.table("results").select(columns).eq("username", username).order("timestamp").order("id")
+        if limit is not None:
+            query = query.range(offset, offset + limit - 1)
+        resp = await query.execute()
+        return resp.data or []
+
+    async def get_result(self, username, result_id, columns="*"):
+        db = await self._db()
+        resp = await db.table("results").select(columns).eq("username", username).eq("id", result_id).execute()
+        return resp.data[0] if resp.data else None
+
+    async def update_result(self, username, result_id, values):
+        db = await self._db()
+        await db.table("results").update(values).eq("username", username).eq("id", result_id).execute()
+
+    async def delete_result(self, username, result_id):
+        db = await self._db()
+        await db.table("results").delete().eq("username", username).eq("id", result_id).execute()
+
+    async def delete_results(self, username):
+        db = await self._db()
+        await db.table("results").delete().eq("username", username).execute()
+
+
+class SQLiteBackend(StorageBackend):
+    """
+    Database SQLite locale: WAL (letture concorrenti alle scritture), indice su
+    (username, timestamp) e SQL parametrico a testo costante, così sqlite3 riusa gli
+    statement preparati dalla sua cache. sqlite3 è bloccante: le query girano su un pool
+    di SQLITE_THREADS thread, con una connessione per thread, così un database bloccato
+    (fino a busy_timeout) ferma solo la sua query e non l'intero loop di storage, e le
+    chiamate di execute_many procedono davvero in parallelo.
+    """
+
+    SCHEMA = """
+        create table if not exists users (
+            username text primary key,
+            password text not null,
+            reset_token text
+        );
+        create table if not exists results (
+            id integer primary key autoincrement,
+            username text not null,
+            timestamp text not null,
+            heart_rate real,
+            speed real,
+            pace text,
+            pace_sec real,
+            hr_array text,
+            sp_array text,
+            ci_low real,
+            ci_high real,
+            warning text
+        );
+        create index if not exists results_username_timestamp on results (username, timestamp);
+    """
+
+    def __init__(self, path=SQLITE_PATH, threads=SQLITE_THREADS):
+        self.path = path
+        self._executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="sqlite")
+        self._local = threading.local()
+        self._schema_lock = threading.Lock()
+        self._schema_ready = False
+
+    def _db(self):
+        """Connessione del thread corrente, aperta al primo utilizzo"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            import sqlite3
+
+            conn = sqlite3.connect(self.path, cached_statements=256, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("pragma busy_timeout=5000")
+            with self._schema_lock:
+                if not self._schema_ready:
+                    conn.execute("pragma journal_mode=wal")
+                    conn.executescript(self.SCHEMA)
+                    self._schema_ready = True
+            conn.execute("pragma synchronous=normal")
+            self._local.conn = conn
+        return conn
+
+    async def _run(self, query):
+        """Esegue query(connessione) su un thread del pool SQLite, fuori dal loop di storage"""
+        return await asyncio.get_running_loop().run_in_executor(self._executor, lambda: query(self._db()))
+
+    @staticmethod
+    def _columns(columns, allowed):
+        """Valida l'elenco di colonne (entra nel testo SQL, non nei parametri)"""
+        if columns.strip() == "*":
+            return "*"
+        names = [c.strip() for c in columns.split(",")]
+        unknown = [c for c in names if c not in allowed]
+        if unknown:
+            raise ValueError(f"Colonne sconosciute: {', '.join(unknown)}")
+        return ", ".join(names)
+
+    @staticmethod
+    def _assignments(values, allowed):
+        unknown = [c for c in values if c not in allowed]
+        if unknown:
+            raise ValueError(f"Colonne sconosciute: {', '.join(unknown)}")
+        return ", ".join(f"{c} = :{c}" for c in sorted(values))
+
+    async def get_user(self, username, columns="*"):
+        sql = f"select {self._columns(columns, USER_COLUMNS)} from users where username = ? limit 1"
+        row = await self._run(lambda conn: conn.execute(sql, (username,)).fetchone())
+        return dict(row) if row else None
+
+    async def insert_user(self, username, password):
+        await self._run(lambda conn: conn.execute(
+            "insert into users (username, password) values (?, ?)", (username, password)
+        ))
+
+    async def update_user(self, username, values):
+        sql = f"update users set {self._assignments(values, USER_COLUMNS)} where username = :_username"
+        await self._run(lambda conn: conn.execute(sql, dict(values, _username=username)))
+
+    async def delete_user(self, username):
+        deleted = await self._run(lambda conn: conn.execute("delete from users where username = ?", (username,)).rowcount)
+        return deleted > 0
+
+    async def insert_results(self, rows):
+        sql = (f"insert into results ({', '.join(RESULT_COLUMNS)}) "
+               f"values ({', '.join(':' + c for c in RESULT_COLUMNS)})")
+
+        def insert(conn):
+            # Con isolation_level=None `with conn` non apre transazioni: senza un begin esplicito
+            # ogni riga verrebbe salvata da sola e un retry dopo un errore a metà la duplicherebbe
+            conn.execute("begin immediate")
+            try:
+                ids = [conn.execute(sql, {c: row.get(c) for c in RESULT_COLUMNS}).lastrowid for row in rows]
+            except BaseException:
+                conn.execute("rollback")
+                raise
+            conn.execute("commit")
+            return ids
+
+        return await self._run(insert)
+
+    async def select_results(self, username, columns="*", offset=0, limit=None):
+        sql = (f"select {self._columns(columns, RESULT_COLUMNS + ('id',))} from results "
+               "where username = ? order by timestamp, id limit ? offset ?")
+        params = (username, -1 if limit is None else limit, offset)
+        rows = await self._run(lambda conn: conn.execute(sql, params).fetchall())
+        return [dict(row) for row in rows]
+
+    async def get_result(self, username, result_id, columns="*"):
+        sql = f"select {self._columns(columns, RESULT_COLUMNS + ('id',))} from results where username = ? and id = ?"
+        row = await self._run(lambda conn: conn.execute(sql, (username, result_id)).fetchone())
+        return dict(row) if row else None
+
+    async def update_result(self, username, result_id, values):
+        sql = (f"update results set {self._assignments(values, RESULT_COLUMNS)} "
+               "where username = :_username and id = :_id")
+        await self._run(lambda conn: conn.execute(sql, dict(values, _username=username, _id=result_id)))
+
+    async def delete_result(self, username, result_id):
+        await self._run(lambda conn: conn.execute(
+            "delete from results where username = ? and id = ?", (username, result_id)
+        ))
+
+    async def delete_results(self, username):
+        await self._run(lambda conn: conn.execute("delete from results where username = ?", (username,)))
+
+
+# ===============================
+#   RETRY E METRICHE
+# ===============================
+class LatencyHistogram:
+    """Istogramma delle latenze (secondi) a bucket fissi, con percentili approssimati"""
+
+    BOUNDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self.buckets = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.errors = 0
+        self.retries = 0
+
+    def observe(self, seconds):
+        self.buckets[bisect.bisect_left(self.BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+
+    def percentile(self, q):
+        """Limite superiore del bucket che contiene il quantile `q` (0-1)"""
+        if not self.count:
+            return None
+        target = q * self.count
+        seen = 0
+        for bound, n in zip(self.BOUNDS + (float("inf"),), self.buckets):
+            seen += n
+            if seen >= target:
+                return bound
+        return float("inf")
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "retries": self.retries,
+            "mean": self.total / self.count if self.count else None,
+            "p50": self.percentile(0.5),
+            "p95": self.percentile(0.95),
+            "buckets": dict(zip([f"<={b}" for b in self.BOUNDS] + ["inf"], self.buckets)),
+        }
+
+
+_histograms = {}
+_stats_lock = threading.Lock()
+
+
+def _is_transient(exc, idempotent=True):
+    """
+    Errori per cui ha senso riprovare. Per le operazioni non idempotenti (insert) solo
+    quelli sicuramente avvenuti prima che la scrittura arrivasse al database: un timeout
+    in lettura o una connessione caduta a metà potrebbero averla già applicata.
+    """
+    if type(exc).__module__ == "sqlite3":
+        # Database bloccato da un altro processo oltre il busy_timeout (nulla è stato scritto)
+        message = str(exc).lower()
+        return "locked" in message or "busy" in message
+    if type(exc).__module__.startswith("httpx"):
+        import httpx
+
+        if isinstance(exc, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)):
+            return True
+        if isinstance(exc, httpx.TransportError):
+            return idempotent
+    code = str(getattr(exc, "code", "") or "")
+    if not idempotent:
+        return code in _REJECTED_CODES
+    if isinstance(exc, asyncio.TimeoutError):
+        return True
+    return code in _TRANSIENT_CODES or code.startswith("08")
+
+
+async def aexecute(build, name="query"):
+    """
+    Esegue l'operazione `build(backend)` (una coroutine del backend) con retry e backoff
+    esponenziale sugli errori transitori; la latenza di ogni tentativo finisce
+    nell'istogramma `name`. Le insert (`name` che termina con ".insert") non sono
+    idempotenti e vengono ripetute solo se la scrittura non è avvenuta di sicuro.
+    """
+    backend = get_backend()
+    idempotent = not name.endswith(".insert")
+    for attempt in range(STORAGE_RETRIES + 1):
+        start = time.perf_counter()
+        try:
+            response = await build(backend)
+        except Exception as e:
+            with _stats_lock:
+                hist = _histograms.setdefault(name, LatencyHistogram())
+                hist.observe(time.perf_counter() - start)
+                if attempt < STORAGE_RETRIES and _is_transient(e, idempotent):
+                    hist.retries += 1
+                else:
+                    hist.errors += 1
+                    raise
+            await asyncio.sleep(STORAGE_BACKOFF * 2 ** attempt * (0.5 + random.random()))
+            continue
+        with _stats_lock:
+            _histograms.setdefault(name, LatencyHistogram()).observe(time.perf_counter() - start)
+        return response
+
+
+def submit(build, name="query"):
+    """Avvia la query sul loop di storage e restituisce subito un Future"""
+    return asyncio.run_coroutine_threadsafe(aexecute(build, name), _get_loop())
+
+
+def execute(build, name="query"):
+    """Facciata sincrona: esegue un'operazione e ne restituisce il risultato"""
+    return submit(build, name).result()
+
+
+def execute_many(*calls):
+    """
+    Esegue in parallelo più operazioni indipendenti, passate come coppie (name, build).
+    Restituisce i risultati nello stesso ordine; la prima eccezione viene rilanciata.
+    """
+    async def gather():
+        return await asyncio.gather(*(aexecute(build, name) for name, build in calls))
+
+    return asyncio.run_coroutine_threadsafe(gather(), _get_loop()).result()
+
+
+def latency_stats():
+    """Istogrammi di latenza per tipo di chiamata"""
+    with _stats_lock:
+        return {name: hist.as_dict() for name, hist in _histograms.items()}
+
+
+def round_trips():
+    """Numero totale di richieste inviate al backend (tentativi compresi)"""
+    with _stats_lock:
+        return sum(h.count for h in _histograms.values())
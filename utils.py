@@ -1,18 +1,40 @@
-import fitdecode
+import base64
+import hashlib
+import json
 import numpy as np
-import tempfile
+import mmap
+import multiprocessing
 import os
-import pwlf
-from scipy.signal import savgol_filter
+import zlib
+from array import array
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+from contextlib import contextmanager
+
+from cache import LRUCache
+from profiling import count, log_profile, profiling, span
 
 # ===============================
 #   ESTRAZIONE DATI DA FILE FIT
 # ===============================
-def get_conconi_data(file_path):
+def get_conconi_data(source, columnar=False):
+    """
+    Estrae le coppie HR/Speed dai messaggi `record` del file FIT.
+    `source` può essere un percorso, bytes/memoryview o un buffer file-like.
+    Con columnar=True usa il decoder colonnare (array NumPy), altrimenti fitdecode (liste).
+    """
+    if columnar:
+        try:
+            columns = read_record_columns(source)
+        except Exception as e:
+            return [], [], str(e)
+        return columns["heart_rate"], columns["speed"], None
+
     heart_rates = []
     speeds = []
     try:
-        with fitdecode.FitReader(file_path) as fit_file:
+        import fitdecode  # caricato solo per il percorso completo / fallback
+
+        with fitdecode.FitReader(source) as fit_file:
             for frame in fit_file:
                 if frame.frame_type == fitdecode.FIT_FRAME_DATA and frame.name == "record":
                     hr = frame.get_value('heart_rate')
@@ -24,12 +46,186 @@ def get_conconi_data(file_path):
         return [], [], str(e)
     return heart_rates, speeds, None
 
+# ===============================
+#   BUFFER IN MEMORIA
+# ===============================
+@contextmanager
+def open_fit_buffer(source):
+    """
+    Espone il contenuto FIT come memoryview senza copie:
+    - bytes / bytearray / memoryview: vista diretta
+    - buffer con getbuffer() (BytesIO, UploadedFile di Streamlit): vista sul buffer interno
+    - percorso: mmap del file in sola lettura
+    - altri file-like: lettura completa (unico caso con copia)
+    """
+    mapped = None
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        view = memoryview(source).cast("B")
+    elif hasattr(source, "getbuffer"):
+        view = source.getbuffer()
+    elif hasattr(source, "read"):
+        view = memoryview(source.read())
+    else:
+        with open(source, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                view = memoryview(b"")
+            else:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                view = memoryview(mapped)
+    try:
+        yield view
+    finally:
+        view.release()
+        if mapped is not None:
+            mapped.close()
+
+# ===============================
+#   DECODER COLONNARE FIT (FAST PATH)
+# ===============================
+FIT_EPOCH_OFFSET = 631065600  # secondi tra 1970-01-01 e 1989-12-31 (epoca FIT)
+RECORD_MESG_NUM = 20
+
+# campo -> (numero campo FIT, dimensione attesa in byte, scala)
+_RECORD_FIELDS = {
+    "timestamp": (253, 4, 1),
+    "heart_rate": (3, 1, 1),
+    "speed": (6, 2, 1000),
+    "enhanced_speed": (73, 4, 1000),
+    "distance": (5, 4, 100),
+}
+_INVALID = {1: 0xFF, 2: 0xFFFF, 4: 0xFFFFFFFF}
+
+
+def _scan_fit_records(raw):
+    """
+    Scansiona i messaggi FIT una sola volta e restituisce, per ogni layout dei messaggi
+    `record`, gli offset dei payload e la loro posizione nel flusso. Gli altri messaggi
+    vengono saltati leggendo solo l'header, senza decodificarne i campi.
+    """
+    groups = {}        # layout -> (offset payload, indice record)
+    compressed = []    # (indice record, time offset) per header a timestamp compresso
+    n_records = 0
+    pos = 0
+    total = len(raw)
+
+    # Supporta anche i "chained FIT files": più file concatenati nello stesso flusso
+    while pos + 12 <= total:
+        header_size = raw[pos]
+        if raw[pos + 8:pos + 12] != b".FIT":
+            raise ValueError("Header FIT non valido.")
+        data_size = int.from_bytes(raw[pos + 4:pos + 8], "little")
+        pos += header_size
+        end = pos + data_size
+        if end > total:
+            raise ValueError("File FIT troncato.")
+
+        local_defs = {}
+        while pos < end:
+            h = raw[pos]
+            if h & 0x80:
+                # Header compresso: tipo locale nei bit 5-6, time offset nei bit 0-4
+                size, layout = local_defs[(h >> 5) & 0x03]
+                if layout is not None:
+                    offsets, indices = groups[layout]
+                    offsets.append(pos + 1)
+                    indices.append(n_records)
+                    compressed.append((n_records, h & 0x1F))
+                    n_records += 1
+                pos += 1 + size
+            elif h & 0x40:
+                # Messaggio di definizione
+                big_endian = raw[pos + 2] == 1
+                global_num = int.from_bytes(raw[pos + 3:pos + 5], "big" if big_endian else "little")
+                n_fields = raw[pos + 5]
+                fields = raw[pos + 6:pos + 6 + 3 * n_fields]
+                p = pos + 6 + 3 * n_fields
+                size = sum(fields[1::3])
+                if h & 0x20:
+                    n_dev = raw[p]
+                    size += sum(raw[p + 1:p + 1 + 3 * n_dev][1::3])
+                    p += 1 + 3 * n_dev
+
+                layout = None
+                if global_num == RECORD_MESG_NUM:
+                    field_offsets = {}
+                    offset = 0
+                    for i in range(n_fields):
+                        field_offsets[fields[3 * i]] = (offset, fields[3 * i + 1])
+                        offset += fields[3 * i + 1]
+                    layout = (big_endian,) + tuple(
+                        field_offsets.get(num, (None, None)) for num, _, _ in _RECORD_FIELDS.values()
+                    )
+                    groups.setdefault(layout, (array("q"), array("q")))
+                local_defs[h & 0x0F] = (size, layout)
+                pos = p
+            else:
+                # Messaggio dati
+                size, layout = local_defs[h & 0x0F]
+                if layout is not None:
+                    offsets, indices = groups[layout]
+                    offsets.append(pos + 1)
+                    indices.append(n_records)
+                    n_records += 1
+                pos += 1 + size
+        pos = end + 2  # CRC del file
+
+    return groups, compressed, n_records
+
+
+def read_record_columns(source):
+    """
+    Decodifica solo i campi necessari dei messaggi `record` direttamente in array NumPy
+    preallocati. Restituisce un dict con heart_rate, speed (m/s), timestamp (secondi Unix)
+    e distance (m), limitato ai record con HR e velocità validi.
+    """
+    with open_fit_buffer(source) as raw:
+        columns = _decode_record_columns(raw)
+    return columns
+
+
+def _decode_record_columns(raw):
+    groups, compressed, n_records = _scan_fit_records(raw)
+    data = np.frombuffer(raw, dtype=np.uint8)
+
+    columns = {name: np.full(n_records, np.nan) for name in _RECORD_FIELDS}
+    for layout, (offsets, indices) in groups.items():
+        big_endian = layout[0]
+        offsets = np.frombuffer(offsets, dtype=np.int64)
+        indices = np.frombuffer(indices, dtype=np.int64)
+        for (name, (_, expected_size, scale)), (field_offset, size) in zip(_RECORD_FIELDS.items(), layout[1:]):
+            if field_offset is None or size != expected_size:
+                continue
+            raw_bytes = data[(offsets + field_offset)[:, None] + np.arange(size)]
+            dtype = np.dtype(f"u{size}").newbyteorder(">" if big_endian else "<")
+            values = raw_bytes.view(dtype).ravel()
+            column = values.astype(np.float64)
+            column[values == _INVALID[size]] = np.nan
+            columns[name][indices] = column / scale if scale != 1 else column
+    del data  # rilascia l'export sul buffer sorgente
+
+    # Header compressi: il timestamp si ricostruisce dal precedente e dai 5 bit di offset
+    timestamps = columns["timestamp"]
+    for i, time_offset in compressed:
+        if i > 0 and not np.isnan(timestamps[i - 1]):
+            last = int(timestamps[i - 1])
+            timestamps[i] = last + ((time_offset - (last & 0x1F)) & 0x1F)
+
+    # Alcuni dispositivi registrano solo enhanced_speed
+    speed = columns.pop("speed")
+    enhanced = columns.pop("enhanced_speed")
+    columns["speed"] = np.where(np.isnan(speed), enhanced, speed)
+
+    valid = ~np.isnan(columns["heart_rate"]) & ~np.isnan(columns["speed"])
+    columns = {name: values[valid] for name, values in columns.items()}
+    columns["timestamp"] += FIT_EPOCH_OFFSET
+    return columns
+
 import numpy as np
-import pwlf
-from scipy.signal import savgol_filter
 
 def smooth_data(data, window=11, polyorder=3):
     """Applica filtro Savitzky-Golay ai dati."""
+    from scipy.signal import savgol_filter  # import pesante, solo al primo fit
+
     if len(data) < window:
         return np.array(data)
     if window % 2 == 0:
@@ -53,47 +249,150 @@ def remove_outliers_pair(hr, sp):
     mask = hr_mask & sp_mask  # mantiene solo coppie valide
     return hr[mask], sp[mask]
 
-def calculate_anaerobic_threshold(hr, sp, window=11, polyorder=3):
+# ===============================
+#   FIT A DUE SEGMENTI (BREAKPOINT ESATTO)
+# ===============================
+def _two_segment_breakpoints(x, Y):
+    """
+    Breakpoint ottimo del fit lineare continuo a due segmenti per ogni riga di Y.
+    `x` deve essere ordinato (n,), `Y` ha forma (B, n). Tutte le posizioni candidate
+    vengono valutate in O(n) con somme prefisse (metodo di Hudson):
+    - breakpoint interno a (x_k, x_k+1): intersezione delle due rette OLS separate,
+      valida solo se cade nell'intervallo;
+    - breakpoint su un punto x_j: fit a 3 parametri con base 1, x, max(0, x - x_j).
+    """
+    x = np.asarray(x, dtype=float)
+    Y = np.atleast_2d(np.asarray(Y, dtype=float))
+    n = x.size
+
+    # Centratura per stabilità numerica delle somme prefisse
+    x_mean = x.mean()
+    x = x - x_mean
+    Y = Y - Y.mean(axis=1, keepdims=True)
+
+    cn = np.arange(1, n + 1, dtype=float)
+    cx, cxx = np.cumsum(x), np.cumsum(x * x)
+    cy, cxy, cyy = np.cumsum(Y, axis=1), np.cumsum(Y * x, axis=1), np.cumsum(Y * Y, axis=1)
+    tx, txx = cx[-1], cxx[-1]
+    ty, txy, tyy = cy[:, -1:], cxy[:, -1:], cyy[:, -1:]
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # --- Rette separate su sinistra {0..k} e destra {k+1..n-1}, k = 0..n-2
+        k = np.arange(n - 1)
+        nl, nr = cn[k], n - cn[k]
+        sxl, sxxl = cx[k], cxx[k]
+        sxr, sxxr = tx - sxl, txx - sxxl
+        syl, sxyl, syyl = cy[:, k], cxy[:, k], cyy[:, k]
+        syr, sxyr, syyr = ty - syl, txy - sxyl, tyy - syyl
+
+        vxxl, vxxr = sxxl - sxl ** 2 / nl, sxxr - sxr ** 2 / nr
+        vxyl, vxyr = sxyl - sxl * syl / nl, sxyr - sxr * syr / nr
+        bl, br = vxyl / vxxl, vxyr / vxxr
+        al, ar = (syl - bl * sxl) / nl, (syr - br * sxr) / nr
+        sse_split = (syyl - syl ** 2 / nl - vxyl * bl) + (syyr - syr ** 2 / nr - vxyr * br)
+
+        t = (ar - al) / (bl - br)
+        ok = (nl >= 2) & (nr >= 2) & (vxxl > 0) & (vxxr > 0) & (x[k] < x[k + 1])
+        ok = ok & (t >= x[k]) & (t <= x[k + 1]) & np.isfinite(sse_split)
+        sse_split = np.where(ok, sse_split, np.inf)
+        t = np.where(ok, t, np.nan)
+
+        # --- Breakpoint sui punti dati x_j, j = 1..n-2 (almeno un punto a destra)
+        j = np.arange(1, n - 1)
+        xj = x[j]
+        nrj = n - cn[j]
+        sxr_j, sxxr_j = tx - cx[j], txx - cxx[j]
+        h1 = sxr_j - nrj * xj
+        h2 = sxxr_j - 2 * xj * sxr_j + nrj * xj ** 2
+        xh = sxxr_j - xj * sxr_j
+        # Equazioni normali 3x3 risolte in forma chiusa; con x e Y centrati
+        # sum(x) = sum(y) = 0, quindi il termine noto è (0, sum(xy), sum(yh))
+        a11 = n * h2 - h1 ** 2
+        a12 = -n * xh
+        a22 = n * txx
+        det = n * (txx * h2 - xh ** 2) - h1 ** 2 * txx
+        yh = (txy - cxy[:, j]) - xj * (ty - cy[:, j])
+        quad = a11 * txy ** 2 + a22 * yh ** 2 + 2 * a12 * txy * yh
+        singular = ~(np.abs(det) > 1e-12 * np.maximum(n * txx * h2, 1e-300))
+        sse_knot = np.where(singular, np.inf, tyy - quad / det)
+
+    candidates = np.concatenate([sse_split, sse_knot], axis=1)
+    positions = np.concatenate([t, np.broadcast_to(xj, sse_knot.shape)], axis=1)
+    best = np.argmin(candidates, axis=1)
+    breakpoints = positions[np.arange(Y.shape[0]), best]
+    breakpoints[~np.isfinite(candidates.min(axis=1))] = np.nan
+    return breakpoints + x_mean
+
+
+def fit_two_segments(x, y):
+    """
+    Fit lineare continuo a due segmenti con un breakpoint, deterministico ed esatto.
+    Restituisce: breakpoint, slopes [prima, dopo], y_fit (sui punti di x), y al breakpoint
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    if x.size < 4:
+        raise ValueError("Servono almeno 4 punti per un fit a due segmenti.")
+
+    order = np.argsort(x, kind="stable")
+    breakpoint = _two_segment_breakpoints(x[order], y[order][None, :])[0]
+    if not np.isfinite(breakpoint):
+        raise ValueError("Breakpoint non determinabile (dati degeneri).")
+
+    # Fit finale a 3 parametri con il breakpoint fissato: y = a + b*x + c*max(0, x - bp)
+    A = np.column_stack([np.ones_like(x), x, np.maximum(0.0, x - breakpoint)])
+    (a, b, c), *_ = np.linalg.lstsq(A, y, rcond=None)
+    slopes = np.array([b, b + c])
+    return breakpoint, slopes, A @ np.array([a, b, c]), a + b * breakpoint
+
+
+def calculate_anaerobic_threshold(hr, sp, window=11, polyorder=3, n_bootstrap=1000, rng=None,
+                                  smooth=True, min_points=10):
     """
     Calcola la soglia anaerobica da serie HR e velocità (Speed).
+    Con smooth=False (punti già aggregati per stage) salta rimozione outlier e smoothing.
     Restituisce: hr_threshold, speed_threshold, idx, ci_low, ci_high, warning
     """
     warning = None
 
     # 1️⃣ Controllo lunghezza dati
-    if len(hr) < 10 or len(sp) < 10:
+    if len(hr) < min_points or len(sp) < min_points:
         return None, None, None, None, None, "Dati troppo corti per calcolare la soglia."
 
-    # 2️⃣ Rimozione outlier
-    hr_filtered, sp_filtered = remove_outliers_pair(hr, sp)
-    if len(hr_filtered) < 10:
-        return None, None, None, None, None, "Troppi outlier, dati insufficienti."
+    if smooth:
+        # 2️⃣ Rimozione outlier
+        with span("remove_outliers"):
+            hr_filtered, sp_filtered = remove_outliers_pair(hr, sp)
+        count("outliers_dropped", len(hr) - len(hr_filtered))
+        if len(hr_filtered) < min_points:
+            return None, None, None, None, None, "Troppi outlier, dati insufficienti."
 
-    # 3️⃣ Smoothing
-    hr_smooth = smooth_data(hr_filtered, window=window, polyorder=polyorder)
-    sp_smooth = smooth_data(sp_filtered, window=window, polyorder=polyorder)
+        # 3️⃣ Smoothing
+        with span("smooth"):
+            hr_smooth = smooth_data(hr_filtered, window=window, polyorder=polyorder)
+            sp_smooth = smooth_data(sp_filtered, window=window, polyorder=polyorder)
+    else:
+        hr_smooth = np.asarray(hr, dtype=float)
+        sp_smooth = np.asarray(sp, dtype=float)
 
 
-    # 5️⃣ Fit piecewise lineare (PWLF)
+    # 5️⃣ Fit lineare a due segmenti (breakpoint esatto, deterministico)
     try:
-        pwlf_model = pwlf.PiecewiseLinFit(sp_smooth, hr_smooth)
-        breaks = pwlf_model.fit(2)
-        hr_fit = pwlf_model.predict(sp_smooth)
+        with span("fit"):
+            threshold_speed, slopes, hr_fit, threshold_hr = fit_two_segments(sp_smooth, hr_smooth)
         # 🔹 Controllo pendenza
-        slopes = pwlf_model.calc_slopes()
-        if len(slopes) >= 2 and slopes[1] > slopes[0] * 0.9:
-            return None, None, None, None, "Soglia non calcolabile: curva HR non decrescente dopo break"
+        if slopes[1] > slopes[0] * 0.9:
+            return None, None, None, None, None, "Soglia non calcolabile: curva HR non decrescente dopo break"
     except Exception as e:
-        return None, None, None, None, None, f"Errore nel fit PWLF: {e}"
+        return None, None, None, None, None, f"Errore nel fit a due segmenti: {e}"
 
-    threshold_speed = breaks[1]
-    threshold_hr = pwlf_model.predict([threshold_speed])[0]
     idx = int(np.argmin(np.abs(sp_smooth - threshold_speed)))
 
     # 6️⃣ Calcolo intervallo di confidenza con bootstrap (funzione esterna)
     residuals = hr_smooth - hr_fit
     try:
-        ci_low, ci_high = bootstrap_threshold(sp_smooth, hr_fit, residuals)
+        with span("bootstrap"):
+            ci_low, ci_high = bootstrap_threshold(sp_smooth, hr_fit, residuals, n_bootstrap=n_bootstrap, rng=rng)
     except:
         ci_low, ci_high = None, None
 
@@ -109,72 +408,618 @@ def calculate_anaerobic_threshold(hr, sp, window=11, polyorder=3):
 # ===============================
 #   BOOTSTRAP CI
 # ===============================
-def bootstrap_threshold(sp, hr_fit, residuals, n_bootstrap=50, alpha=0.05):
+BOOTSTRAP_BLOCK_ELEMENTS = 500_000   # elementi (repliche x punti) per blocco: limita la memoria
+BOOTSTRAP_CHUNK = 32                 # repliche massime per blocco
+BOOTSTRAP_WAVE = 256                 # repliche tra due controlli di convergenza
+BOOTSTRAP_PARALLEL_WORK = 20_000_000 # repliche x punti oltre cui si usa il process pool
+
+_process_pool = None
+_in_worker_process = False
+
+
+def _mp_context():
+    """
+    Start method dei process pool: forkserver (spawn dove non esiste). Il server Streamlit
+    ha già più thread attivi (loop di storage, pool bcrypt, chat, CI in background) e un
+    fork può ereditare lock tenuti da quei thread e bloccarsi; i worker ripartono puliti
+    e le funzioni che eseguono sono a livello di modulo, quindi serializzabili.
+    """
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+
+
+def _get_process_pool():
+    """
+    Process pool condiviso a livello di processo, creato al primo utilizzo.
+    Nei worker di analyze_fit_files restituisce None (esecuzione seriale).
+    """
+    global _process_pool
+    if _in_worker_process:
+        return None
+    if _process_pool is None:
+        _process_pool = ProcessPoolExecutor(mp_context=_mp_context())
+    return _process_pool
+
+
+def _bootstrap_chunk(sp_sorted, fit_sorted, residuals, rng, size):
+    """Un blocco di repliche: matrice (size x n) di residui ricampionati, breakpoint in batch."""
+    idx = rng.integers(0, residuals.size, size=(size, residuals.size))
+    return _two_segment_breakpoints(sp_sorted, fit_sorted + residuals[idx])
+
+
+def bootstrap_threshold(sp, hr_fit, residuals, n_bootstrap=1000, alpha=0.05, rng=None, tol=0.05):
+    """
+    Intervallo di confidenza del breakpoint con bootstrap sui residui.
+    Le repliche sono generate a blocchi come matrici (B x n) e i breakpoint di tutte
+    le repliche vengono calcolati in batch. Ogni BOOTSTRAP_WAVE repliche si controlla la
+    convergenza: ci si ferma quando entrambi i limiti si spostano meno di `tol` volte
+    l'ampiezza dell'intervallo. `rng` può essere un numpy.random.Generator o un seed.
+    """
+    rng = np.random.default_rng(rng)
+    sp = np.asarray(sp, dtype=float)
+    order = np.argsort(sp, kind="stable")
+    sp_sorted = sp[order]
+    fit_sorted = np.asarray(hr_fit, dtype=float)[order]
+    residuals = np.asarray(residuals, dtype=float)
+    n = residuals.size
+
+    chunk = max(1, min(BOOTSTRAP_CHUNK, BOOTSTRAP_BLOCK_ELEMENTS // max(n, 1)))
+    pool = _get_process_pool() if n_bootstrap * n >= BOOTSTRAP_PARALLEL_WORK else None
+
     thresholds = []
-    sp = np.array(sp)
-    for _ in range(n_bootstrap):
-        resampled_resid = np.random.choice(residuals, size=len(residuals), replace=True)
-        hr_boot = hr_fit + resampled_resid
-        try:
-            pwlf_boot = pwlf.PiecewiseLinFit(sp, hr_boot)
-            breaks_boot = pwlf_boot.fit(2)
-            thresholds.append(breaks_boot[1])
-        except:
+    bounds = None
+    done = 0
+    while done < n_bootstrap:
+        wave = min(BOOTSTRAP_WAVE, n_bootstrap - done)
+        sizes = [min(chunk, wave - i) for i in range(0, wave, chunk)]
+        # Un generatore figlio per blocco: risultati identici in seriale e in parallelo
+        rngs = rng.spawn(len(sizes))
+        if pool is not None:
+            futures = [pool.submit(_bootstrap_chunk, sp_sorted, fit_sorted, residuals, r, size)
+                       for r, size in zip(rngs, sizes)]
+            blocks = [f.result() for f in futures]
+        else:
+            blocks = [_bootstrap_chunk(sp_sorted, fit_sorted, residuals, r, size)
+                      for r, size in zip(rngs, sizes)]
+        done += wave
+
+        for block in blocks:
+            valid = np.isfinite(block)
+            thresholds.extend(block[valid])
+            count("bootstrap_replicates", block.size)
+            count("bootstrap_failed", block.size - valid.sum())
+        if not thresholds:
             continue
-    if len(thresholds) == 0:
+
+        new_bounds = np.percentile(thresholds, [alpha / 2 * 100, (1 - alpha / 2) * 100])
+        if bounds is not None:
+            width = new_bounds[1] - new_bounds[0]
+            if np.max(np.abs(new_bounds - bounds)) <= tol * width:
+                bounds = new_bounds
+                break
+        bounds = new_bounds
+
+    if bounds is None:
         return None, None
-    lower = np.percentile(thresholds, alpha/2*100)
-    upper = np.percentile(thresholds, (1-alpha/2)*100)
-    return lower, upper
+    return bounds[0], bounds[1]
 
 # ===============================
 #   CONVERSIONE VELOCITÀ -> PASSO
 # ===============================
+def speed_to_pace_seconds(speed):
+    """Velocità in m/s (scalare o array) -> passo in secondi al km; NaN se la velocità non è positiva"""
+    sp = np.asarray(speed, dtype=float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(sp > 0, 1000.0 / sp, np.nan)
+
+def format_pace(seconds):
+    """
+    Secondi al km (scalare o array) -> "m:ss". Da usare solo per la visualizzazione:
+    restituisce una stringa per uno scalare, una lista di stringhe per un array.
+    """
+    sec = np.asarray(seconds, dtype=float)
+    valid = np.isfinite(sec) & (sec > 0)
+    total = np.where(valid, np.floor(np.where(valid, sec, 0)), 0).astype(np.int64)
+    text = np.char.add(np.char.add((total // 60).astype(str), ":"), np.char.zfill((total % 60).astype(str), 2))
+    text = np.where(valid, text, "N/A")
+    return str(text) if text.ndim == 0 else text.tolist()
+
 def speed_to_pace(speed):
-    if speed <= 0:
-        return "N/A"
-    sec_per_km = 1000 / speed
-    minutes = int(sec_per_km // 60)
-    seconds = int(sec_per_km % 60)
-    return f"{minutes}:{seconds:02d}"
+    return format_pace(speed_to_pace_seconds(speed))
+
+# ===============================
+#   SOTTOCAMPIONAMENTO PER I GRAFICI
+# ===============================
+def lttb_indices(x, y, n_out):
+    """
+    Largest-Triangle-Three-Buckets: sceglie `n_out` indici che preservano la forma
+    della curva (primo e ultimo punto sempre inclusi). Per ogni bucket tiene il punto
+    che forma il triangolo più grande con il punto scelto prima e la media del bucket dopo.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    n = x.size
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.intp)
+    idx = np.empty(n_out, dtype=np.intp)
+    idx[0], idx[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        if i + 2 < edges.size:
+            next_x = x[end:edges[i + 2]].mean()
+            next_y = y[end:edges[i + 2]].mean()
+        else:
+            next_x, next_y = x[-1], y[-1]
+        area = np.abs((x[a] - next_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (next_y - y[a]))
+        a = start + int(np.argmax(area))
+        idx[i + 1] = a
+    return idx
+
+# ===============================
+#   CODIFICA COMPATTA DELLE SERIE
+# ===============================
+SERIES_FORMAT = "c1"  # versione: delta modulare + zlib + base64
+
+HR_SERIES_DTYPE, HR_SERIES_SCALE = "u1", 1        # bpm interi 0-255
+SPEED_SERIES_DTYPE, SPEED_SERIES_SCALE = "u2", 1000  # mm/s (risoluzione nativa FIT)
+
+
+def encode_series(values, dtype, scale=1):
+    """
+    Codifica una serie numerica in virgola fissa come stringa compatta:
+    "c1:<dtype>:<scale>:<base64(zlib(delta))>". Le differenze successive sono calcolate
+    in aritmetica modulare sul tipo intero, così la decodifica è un cumsum sullo stesso tipo.
+    """
+    info = np.iinfo(np.dtype(dtype))
+    fixed = np.clip(np.rint(np.asarray(values, dtype=float) * scale), info.min, info.max).astype(dtype)
+    deltas = np.diff(fixed, prepend=fixed.dtype.type(0))
+    payload = base64.b64encode(zlib.compress(deltas.astype(f"<{dtype}").tobytes(), 9)).decode("ascii")
+    return f"{SERIES_FORMAT}:{dtype}:{scale}:{payload}"
+
+
+def decode_series(x):
+    """
+    Decodifica una serie salvata: formato compatto, JSON legacy o lista.
+    Restituisce un array float64 (vuoto se il valore non è leggibile).
+    """
+    if isinstance(x, (list, tuple, np.ndarray)):
+        return np.asarray(x, dtype=float)
+    if not isinstance(x, str):
+        return np.empty(0)
+    try:
+        if x.startswith(SERIES_FORMAT + ":"):
+            _, dtype, scale, payload = x.split(":", 3)
+            deltas = np.frombuffer(zlib.decompress(base64.b64decode(payload)), dtype=f"<{dtype}")
+            return np.cumsum(deltas, dtype=dtype) / float(scale)
+        return np.asarray(json.loads(x), dtype=float)
+    except (ValueError, TypeError, zlib.error):
+        return np.empty(0)
+
+
+# ===============================
+#   SEGMENTAZIONE IN STAGE
+# ===============================
+STAGE_LENGTH = 200.0    # metri per stage (protocollo Conconi)
+STAGE_TAIL = 30.0       # secondi finali di ogni stage usati per la FC
+STAGE_MIN_SAMPLES = 5   # campioni minimi perché uno stage sia valido
+STAGE_MIN_POINTS = 6    # stage minimi per il fit
+STAGE_STEP_WINDOW = 15  # campioni per lato nel confronto delle mediane di velocità
+STAGE_LENGTH_TOLERANCE = 0.35  # scarto relativo ammesso sulla lunghezza di uno stage rilevato
+
+
+def detect_speed_steps(speed, window=STAGE_STEP_WINDOW, min_gap=None):
+    """
+    Indici dei cambi di velocità (inizio di uno stage, del riscaldamento o del defaticamento):
+    punti in cui la mediana dei `window` campioni successivi differisce da quella dei
+    `window` precedenti oltre una soglia adattata al rumore della velocità. Tra due cambi
+    ci sono almeno `min_gap` campioni (default `window`).
+    """
+    sp = np.asarray(speed, dtype=float)
+    if sp.size < 2 * window + 1:
+        return np.empty(0, dtype=np.int64)
+    min_gap = window if min_gap is None else max(int(min_gap), 1)
+
+    medians = np.median(np.lib.stride_tricks.sliding_window_view(sp, window), axis=1)
+    jump = np.abs(medians[window:] - medians[:-window])  # jump[j]: cambio al campione j + window
+    # Rumore dalle differenze prime (MAD); differenza di due mediane: sigma * sqrt(pi / window)
+    diffs = np.diff(sp)
+    noise = 1.4826 * np.median(np.abs(diffs - np.median(diffs))) / np.sqrt(2)
+    threshold = max(0.03, 3 * noise * np.sqrt(np.pi / window))
+
+    # Un picco per ogni tratto contiguo sopra soglia
+    above = np.flatnonzero(jump > threshold)
+    if above.size == 0:
+        return np.empty(0, dtype=np.int64)
+    run = np.cumsum(np.r_[True, np.diff(above) > 1])
+    order = np.lexsort((-jump[above], run))
+    peaks = above[order[np.r_[True, np.diff(run[order]) > 0]]]
+
+    # Distanza minima tra i cambi: tiene il più marcato
+    kept = []
+    for peak in peaks[np.argsort(-jump[peaks], kind="stable")]:
+        if all(abs(peak - other) >= min_gap for other in kept):
+            kept.append(peak)
+    return np.sort(np.asarray(kept, dtype=np.int64)) + window
+
+
+def _stage_bins(d, t, steps, stage_length):
+    """
+    Stage (inizi, fine) ancorati ai cambi di velocità `steps`. Un tratto tra due cambi
+    lungo circa k stage ha k - 1 cambi non rilevati e viene diviso in k finestre uguali.
+    Si parte dal primo tratto lungo uno stage: in avanti si prosegue finché la velocità
+    cresce (il defaticamento è più lento) e dell'ultimo tratto registrato si tengono solo
+    gli stage completati; all'indietro si aggiungono tratti solo se la velocità scende di
+    circa un gradino per stage, così il riscaldamento resta escluso.
+    """
+    starts = np.r_[0, steps]
+    ends = np.r_[steps, d.size] - 1
+    length = d[ends] - d[starts]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        speed = length / (t[ends] - t[starts])
+    n_bins = np.rint(length / stage_length).astype(np.int64)
+    fits = (n_bins >= 1) & (np.abs(length - n_bins * stage_length) <= STAGE_LENGTH_TOLERANCE * stage_length)
+    single = np.flatnonzero(fits & (n_bins == 1))
+    if single.size == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    last = starts.size - 1
+
+    def split(i):
+        if i == last:
+            bins, width = int(length[i] / stage_length + 0.1), stage_length
+        else:
+            bins, width = int(n_bins[i]), length[i] / n_bins[i]
+        if bins < 1:
+            return []
+        cuts = np.searchsorted(d, d[starts[i]] + width * np.arange(1, bins + 1))
+        bin_ends = np.r_[cuts[:-1] - 1, ends[i] if i < last else min(cuts[-1] - 1, ends[i])]
+        return list(zip(np.r_[starts[i], cuts[:-1]], bin_ends))
+
+    def bin_speed(b):
+        return (d[b[1]] - d[b[0]]) / (t[b[1]] - t[b[0]]) if t[b[1]] > t[b[0]] else np.nan
+
+    stages = []
+    for i in range(single[0], last + 1):
+        if i > single[-1] and not speed[i] > speed[single[-1]]:
+            break
+        if fits[i] or i == last:
+            stages += split(i)
+        elif i > single[-1]:
+            break
+
+    # Gradino tipico tra stage consecutivi riconosciuti
+    adjacent = single[:-1][np.diff(single) == 1]
+    step = float(np.median(speed[adjacent + 1] - speed[adjacent])) if adjacent.size else 0.0
+    for i in range(single[0] - 1, -1, -1):
+        if not fits[i] or not step > 0:
+            break
+        bins = split(i)
+        increments = np.diff([bin_speed(b) for b in bins + stages[:1]])
+        if not np.all((increments >= 0.5 * step) & (increments <= 2 * step)):
+            break
+        stages = bins + stages
+
+    stage_starts, stage_ends = zip(*stages) if stages else ((), ())
+    return np.asarray(stage_starts, dtype=np.int64), np.asarray(stage_ends, dtype=np.int64)
+
+
+def aggregate_stages(heart_rate, speed, distance, timestamp, stage_length=STAGE_LENGTH, tail=STAGE_TAIL,
+                     return_ends=False):
+    """
+    Divide i campioni negli stage del protocollo e li riduce a un punto per stage:
+    - FC: media degli ultimi `tail` secondi dello stage (la FC si stabilizza in ritardo);
+    - velocità: distanza percorsa / durata dello stage.
+    Gli stage sono ancorati ai cambi di velocità rilevati (detect_speed_steps, _stage_bins),
+    esclusi riscaldamento e defaticamento. Se i cambi rilevati non bastano si ripiega su
+    finestre fisse di `stage_length` metri dalla fine del riscaldamento.
+    Restituisce (hr_stage, speed_stage) come array; con return_ends=True anche l'indice
+    (nei campioni in ingresso) dell'ultimo campione di ogni stage.
+    """
+    hr = np.asarray(heart_rate, dtype=float)
+    sp = np.asarray(speed, dtype=float)
+    d = np.asarray(distance, dtype=float)
+    t = np.asarray(timestamp, dtype=float)
+    valid = np.isfinite(d) & np.isfinite(t) & np.isfinite(sp)
+    if valid.sum() < STAGE_MIN_SAMPLES:
+        raise ValueError("Distanza o tempo non disponibili: impossibile segmentare gli stage.")
+    positions = np.flatnonzero(valid)
+    hr, sp, d, t = hr[valid], sp[valid], d[valid], t[valid]
+    d = np.maximum.accumulate(d)  # monotona anche con piccole oscillazioni della distanza
+
+    # Durata minima di uno stage (in campioni) alla velocità massima del test
+    dt = float(np.median(np.diff(t))) if t.size > 1 else 1.0
+    top_speed = float(np.percentile(sp, 99)) if sp.size else 0.0
+    min_gap = (1 - STAGE_LENGTH_TOLERANCE) * stage_length / top_speed / dt if top_speed > 0 and dt > 0 else None
+    steps = detect_speed_steps(sp, min_gap=min_gap)
+
+    starts, ends = _stage_bins(d, t, steps, stage_length)
+    keep = ends - starts + 1 >= STAGE_MIN_SAMPLES
+
+    # Fine del riscaldamento: l'aumento di velocità più marcato nella prima metà del test
+    w = STAGE_STEP_WINDOW
+    early = steps[steps < sp.size // 2]
+    rise = [np.median(sp[k:k + w]) - np.median(sp[max(k - w, 0):k]) for k in early]
+    origin = int(early[np.argmax(rise)]) if early.size else 0
+    if keep.sum() < max(STAGE_MIN_POINTS, 0.6 * (d[-1] - d[origin]) / stage_length):
+        # Troppi cambi non riconosciuti: finestre fisse dalla fine del riscaldamento
+        count("stage_fallback")
+        stage = np.floor((d[origin:] - d[origin]) / stage_length).astype(np.int64)
+        starts = origin + np.flatnonzero(np.r_[True, np.diff(stage) > 0])
+        ends = np.r_[starts[1:], sp.size] - 1
+        keep = ends - starts + 1 >= STAGE_MIN_SAMPLES
+        keep[-1] &= d[ends[-1]] - d[starts[-1]] >= 0.9 * stage_length
+    starts, ends = starts[keep], ends[keep]
+    if starts.size == 0:
+        # Es. tapis roulant senza footpod: la distanza resta ferma e non c'è nulla da dividere
+        raise ValueError("Nessuno stage completo: la distanza registrata non permette di segmentare il test.")
+
+    # Stage di ogni campione (-1 fuori dagli stage tenuti)
+    ids = np.searchsorted(starts, np.arange(sp.size), side="right") - 1
+    inside = ids >= 0
+    inside[inside] = np.arange(sp.size)[inside] <= ends[ids[inside]]
+    ids[~inside] = -1
+    in_tail = inside & (t >= (t[ends] - tail)[np.maximum(ids, 0)])
+    hr_stage = np.bincount(ids[in_tail], weights=hr[in_tail], minlength=starts.size) / \
+               np.maximum(np.bincount(ids[in_tail], minlength=starts.size), 1)
+    duration = t[ends] - t[starts]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean_speed = np.bincount(ids[inside], weights=sp[inside], minlength=starts.size) / \
+                     np.maximum(np.bincount(ids[inside], minlength=starts.size), 1)
+        sp_stage = np.where(duration > 0, (d[ends] - d[starts]) / duration, mean_speed)
+
+    if return_ends:
+        return hr_stage, sp_stage, positions[ends]
+    return hr_stage, sp_stage
 
 # ===============================
 #   ANALISI FILE FIT
 # ===============================
-def analyze_fit_file(file_buffer):
-    import io, tempfile, os
+ANALYSIS_VERSION = 3  # da incrementare quando cambia il risultato dell'analisi (invalida la cache)
+
+# Cache dei risultati condivisa da tutte le sessioni del processo
+ANALYSIS_CACHE = LRUCache(
+    max_bytes=int(os.environ.get("CONCONI_CACHE_MB", "256")) * 2**20,
+    spill_dir=os.environ.get("CONCONI_CACHE_DIR") or None,
+)
+
+
+def fit_content_hash(source):
+    """SHA-256 del contenuto del file FIT (percorso, bytes o buffer), senza copie."""
+    with open_fit_buffer(source) as buffer:
+        return hashlib.sha256(buffer).hexdigest()
+
 
-    with tempfile.NamedTemporaryFile(delete=False) as tmp:
-        tmp.write(file_buffer.read())
-        tmp_path = tmp.name
+def _analysis_key(buffer, params):
+    return (hashlib.sha256(buffer).hexdigest(), ANALYSIS_VERSION) + tuple(sorted(params.items()))
 
-    heart_rates, speeds, error = get_conconi_data(tmp_path)
-    os.remove(tmp_path)
 
+def analyze_fit_file(file_buffer, window=11, polyorder=3, trim_start=20, trim_end=10,
+                     n_bootstrap=1000, use_cache=True, mode="samples",
+                     stage_length=STAGE_LENGTH, stage_tail=STAGE_TAIL, profile=False):
+    """
+    Analizza un file FIT passato come percorso, bytes/memoryview o buffer file-like
+    (es. UploadedFile di Streamlit), decodificandolo direttamente dalla memoria.
+    mode="samples" fa il fit sui campioni filtrati e smussati; mode="stages" sui punti
+    aggregati per stage di `stage_length` metri (vedi aggregate_stages).
+    I risultati sono memorizzati in ANALYSIS_CACHE con chiave hash del contenuto + parametri.
+    Con profile=True il risultato contiene un blocco `timings` (tempi per fase e contatori),
+    scritto anche nel log strutturato di profiling.
+    """
+    params = dict(window=window, polyorder=polyorder, trim_start=trim_start,
+                  trim_end=trim_end, n_bootstrap=n_bootstrap, mode=mode,
+                  stage_length=stage_length, stage_tail=stage_tail)
+    with profiling(profile) as prof:
+        result = _analyze_cached(file_buffer, params, use_cache)
+    if prof is not None:
+        result["timings"] = prof.as_dict()
+        log_profile(result["timings"], mode=mode, n_bootstrap=n_bootstrap, error=result.get("error"))
+    return result
+
+
+def _analyze_cached(file_buffer, params, use_cache):
+    try:
+        with open_fit_buffer(file_buffer) as buffer:
+            with span("hash"):
+                key = _analysis_key(buffer, params) if use_cache else None
+            cached = ANALYSIS_CACHE.get(key) if use_cache else None
+            if cached is not None:
+                count("cache_hits")
+                return dict(cached)
+            result = _analyze_buffer(buffer, **params)
+    except OSError as e:
+        return {"error": str(e)}
+
+    if use_cache:
+        ANALYSIS_CACHE.put(key, result)
+    return dict(result)
+
+
+def analyze_fit_files(sources, max_workers=None, use_cache=True, max_pending=None, profile=False, **params):
+    """
+    Analizza più file FIT in parallelo su un process pool.
+    Generatore che restituisce (indice, risultato) man mano che le analisi terminano;
+    gli errori di un file finiscono nel suo risultato senza interrompere gli altri.
+    `sources` può essere un iteratore: al massimo `max_pending` file (default 4 per
+    worker) sono letti e in coda alla volta, così la memoria resta limitata anche con
+    migliaia di file. Con profile=True ogni risultato calcolato contiene `timings`.
+    """
+    params = dict(dict(window=11, polyorder=3, trim_start=20, trim_end=10, n_bootstrap=1000,
+                       mode="samples", stage_length=STAGE_LENGTH, stage_tail=STAGE_TAIL), **params)
+    max_workers = max_workers or os.cpu_count() or 1
+    max_pending = max_pending or 4 * max_workers
+    pending = {}
+    keys = {}
+    pool = ProcessPoolExecutor(max_workers=max_workers, initializer=_mark_worker_process, mp_context=_mp_context())
+
+    def collect(futures):
+        for future in futures:
+            i = pending.pop(future)
+            key = keys.pop(i)
+            try:
+                result = future.result()
+            except Exception as e:
+                yield i, {"error": f"Errore nell'analisi: {e}"}
+                continue
+            timings = result.pop("timings", None)
+            if use_cache:
+                ANALYSIS_CACHE.put(key, result)
+            result = dict(result)
+            if timings is not None:
+                result["timings"] = timings
+            yield i, result
+
+    try:
+        for i, source in enumerate(sources):
+            try:
+                with open_fit_buffer(source) as buffer:
+                    key = _analysis_key(buffer, params) if use_cache else None
+                    cached = ANALYSIS_CACHE.get(key) if use_cache else None
+                    if cached is not None:
+                        yield i, dict(cached)
+                        continue
+                    data = bytes(buffer)
+            except OSError as e:
+                yield i, {"error": str(e)}
+                continue
+            pending[pool.submit(_analyze_in_worker, data, params, profile)] = i
+            keys[i] = key
+            if len(pending) >= max_pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                yield from collect(done)
+
+        yield from collect(as_completed(list(pending)))
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+# Lavori in background (es. intervallo di confidenza dopo la stima puntuale)
+BACKGROUND_WORKERS = int(os.environ.get("CONCONI_BACKGROUND_WORKERS", "2"))
+_background_pool = None
+
+
+def submit_background(func, *args, **kwargs):
+    """
+    Esegue `func` su un thread pool condiviso dal processo e restituisce il Future.
+    Il lavoro continua anche se la sessione Streamlit che l'ha avviato fa un rerun.
+    """
+    global _background_pool
+    if _background_pool is None:
+        _background_pool = ThreadPoolExecutor(max_workers=BACKGROUND_WORKERS, thread_name_prefix="conconi-bg")
+    return _background_pool.submit(func, *args, **kwargs)
+
+
+def _mark_worker_process():
+    """Initializer dei worker di analyze_fit_files: niente pool annidati per il bootstrap."""
+    global _in_worker_process
+    _in_worker_process = True
+
+
+def _analyze_in_worker(data, params, profile=False):
+    with profiling(profile) as prof:
+        result = _analyze_buffer(memoryview(data), **params)
+    if prof is not None:
+        result["timings"] = prof.as_dict()
+    return result
+
+
+def _analyze_buffer(buffer, window, polyorder, trim_start, trim_end, n_bootstrap,
+                    mode="samples", stage_length=STAGE_LENGTH, stage_tail=STAGE_TAIL):
+    start_time = None
+    columns = None
+    try:
+        with span("decode"):
+            columns = read_record_columns(buffer)
+        heart_rates, speeds, error = columns["heart_rate"], columns["speed"], None
+        if columns["timestamp"].size and np.isfinite(columns["timestamp"][0]):
+            start_time = float(columns["timestamp"][0])
+    except Exception:
+        # Fallback sul decoder completo per file che il fast path non gestisce
+        with span("decode_fitdecode"):
+            heart_rates, speeds, error = get_conconi_data(buffer)
+    count("records_decoded", len(heart_rates))
+
+    if mode == "stages":
+        if columns is None:
+            return {"error": error or "Distanza e tempo non disponibili: impossibile segmentare gli stage."}
+        result = _analyze_stages(columns, trim_start, trim_end, n_bootstrap, stage_length, stage_tail)
+    else:
+        result = _analyze_series(heart_rates, speeds, error, window, polyorder, trim_start, trim_end, n_bootstrap)
+    if "error" not in result:
+        result["start_time"] = start_time
+    return result
+
+
+def _analyze_series(heart_rates, speeds, error, window, polyorder, trim_start, trim_end, n_bootstrap):
     if error:
         return {"error": error}
     if len(heart_rates) < 30:
         return {"error": "File troppo corto o con dati insufficienti."}
 
     # Rimuovi valori iniziali/finali rumorosi
-    heart_rates = heart_rates[20:-10]
-    speeds = speeds[20:-10]
+    heart_rates = heart_rates[trim_start:len(heart_rates) - trim_end]
+    speeds = speeds[trim_start:len(speeds) - trim_end]
+
+    hr_threshold, speed_threshold, idx, ci_low, ci_high, warning = calculate_anaerobic_threshold(
+        heart_rates, speeds, window=window, polyorder=polyorder, n_bootstrap=n_bootstrap
+    )
+    if hr_threshold is None:
+        msg = "Impossibile calcolare la soglia anaerobica."
+        if warning:
+            msg += f" ({warning})"
+        return {"error": msg}
 
-    hr_threshold, speed_threshold, idx, ci_low, ci_high, warning = calculate_anaerobic_threshold(heart_rates, speeds)
+    return _threshold_result(heart_rates, speeds, hr_threshold, speed_threshold, idx, ci_low, ci_high, warning)
+
+
+def _analyze_stages(columns, trim_start, trim_end, n_bootstrap, stage_length, stage_tail):
+    n = columns["heart_rate"].size
+    if n < 30:
+        return {"error": "File troppo corto o con dati insufficienti."}
+
+    # Stessa rifilatura della modalità a campioni, poi un punto per stage
+    trimmed = {name: values[trim_start:n - trim_end] for name, values in columns.items()}
+    try:
+        with span("aggregate_stages"):
+            hr_stage, sp_stage, stage_ends = aggregate_stages(
+                trimmed["heart_rate"], trimmed["speed"], trimmed["distance"], trimmed["timestamp"],
+                stage_length=stage_length, tail=stage_tail, return_ends=True,
+            )
+    except (ValueError, IndexError) as e:  # dati che non permettono di segmentare gli stage
+        return {"error": str(e)}
+    count("stages", hr_stage.size)
+    if hr_stage.size < STAGE_MIN_POINTS:
+        return {"error": f"Stage completi insufficienti ({hr_stage.size}, minimo {STAGE_MIN_POINTS})."}
+
+    hr_threshold, speed_threshold, idx, ci_low, ci_high, warning = calculate_anaerobic_threshold(
+        hr_stage, sp_stage, n_bootstrap=n_bootstrap, smooth=False, min_points=STAGE_MIN_POINTS
+    )
     if hr_threshold is None:
         msg = "Impossibile calcolare la soglia anaerobica."
         if warning:
             msg += f" ({warning})"
         return {"error": msg}
 
-    pace = speed_to_pace(speed_threshold)
+    # threshold_idx resta un indice nei campioni (ultimo campione dello stage soglia),
+    # come in modalità a campioni; l'indice dello stage è in stages["threshold_stage"]
+    result = _threshold_result(trimmed["heart_rate"], trimmed["speed"], hr_threshold, speed_threshold,
+                               int(stage_ends[idx]), ci_low, ci_high, warning)
+    result["stages"] = {"heart_rate": hr_stage.tolist(), "speed": sp_stage.tolist(), "threshold_stage": idx}
+    return result
+
+
+def _threshold_result(heart_rates, speeds, hr_threshold, speed_threshold, idx, ci_low, ci_high, warning):
+    pace_sec = float(speed_to_pace_seconds(speed_threshold))
+    pace = format_pace(pace_sec)
 
     return {
-        "heartRate": heart_rates,
-        "speed": speeds,
+        "heartRate": np.asarray(heart_rates, dtype=float).tolist(),
+        "speed": np.asarray(speeds, dtype=float).tolist(),
         "heart_rate": hr_threshold,
         "speed_threshold": speed_threshold,
         "pace": pace,
+        "pace_sec": pace_sec,
         "threshold_idx": idx,
         "ci_low": ci_low,
         "ci_high": ci_high,